@@ -10,19 +10,31 @@
 from __future__ import absolute_import
 
 import ast
+import bisect
 import chardet
 import copy
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import numbers
 import os
 import re
 import shutil
+import sqlite3
+import tempfile
 import unicodecsv as csv
 from collections import OrderedDict
+from contextlib import contextmanager
+from chardet.universaldetector import UniversalDetector
 from .dateutil import parser as dateutil_parser
 from .distance import distance
 from .pydicom.filereader import InvalidDicomError
 from . import pydicom
 
+import numpy as np
 import pandas as pd
 
 try:
@@ -55,99 +67,255 @@ try:
 except ImportError as exc:
     from io import StringIO as _StringIO
 
+try:
+    from itertools import izip
+except ImportError as exc:
+    izip = zip
+
+try:
+    import cPickle as pickle
+except ImportError as exc:
+    import pickle
+
 def _str(s):
     """Convert to str only if the object is not unicode"""
     return str(s) if not isinstance(s, unicode) else s
 
 def save_dict_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbose=False):
-    """Save a dict/list of dictionaries in a csv, with each key being a column
-    Note: Does NOT support unicode, nor quotes. See Python doc to get UnicodeWriter for unicode support (but quotes unsupport is due to inner working, can't fix that)"""
+    """Save a dict/list of dictionaries in a csv, with each key being a column (the columns are the ones in fields_order followed by the other keys of the first dictionary, in alphabetical order)
+    Note: Does NOT support unicode, nor quotes. See Python doc to get UnicodeWriter for unicode support (but quotes unsupport is due to inner working, can't fix that)
+    See save_dict_as_csv_stream() to save records as they are generated, without holding them all in memory."""
+    return save_dict_as_csv_stream(d, output_file, fields_order=fields_order, csv_order_by=csv_order_by, infer_rows=1, max_rows_in_memory=None, verbose=verbose)
+
+def _spill_sorted_run(rows, keyfunc):
+    """Sort a run of records and spill it to a temporary file (deleted when closed), returned rewound"""
+    f = tempfile.TemporaryFile()
+    for row in sorted(rows, key=keyfunc):
+        pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _read_spilled_run(f, runid, keyfunc):
+    """Generate the records spilled in a temporary file by _spill_sorted_run(), decorated as (key, runid, position, record) so that merging runs keeps ties in their original order and never compares the records themselves"""
+    pos = 0
+    while True:
+        try:
+            row = pickle.load(f)
+        except EOFError:
+            return
+        yield (keyfunc(row), runid, pos, row)
+        pos += 1
+
+def external_sort(records, keyfunc, max_rows_in_memory=100000):
+    """Generate the records of an iterable sorted by keyfunc (stable sort like sorted()), using bounded memory: runs of max_rows_in_memory records are sorted and spilled to temporary files, which are then lazily merged. If all the records fit in one run, they are sorted in memory. If max_rows_in_memory is None, everything is sorted in memory."""
+    runs = []
+    try:
+        buf = []
+        for row in records:
+            buf.append(row)
+            if max_rows_in_memory and len(buf) >= max_rows_in_memory:
+                runs.append(_spill_sorted_run(buf, keyfunc))
+                buf = []
+        if not runs:
+            for row in sorted(buf, key=keyfunc):
+                yield row
+            return
+        if buf:
+            runs.append(_spill_sorted_run(buf, keyfunc))
+            buf = []
+        # Merge the runs
+        for _, _, _, row in heapq.merge(*[_read_spilled_run(f, runid, keyfunc) for runid, f in enumerate(runs)]):
+            yield row
+    finally:
+        for f in runs:
+            f.close()
+
+def save_dict_as_csv_stream(records, output_file, fields_order=None, csv_order_by=None, infer_rows=100, max_rows_in_memory=100000, verbose=False):
+    """Save an iterable (eg, a generator) of dictionaries in a csv, with each key being a column, writing the rows as they arrive instead of holding them all in memory (a dict of dictionaries can also be given, its values are then saved).
+    The columns are the ones in fields_order, followed by the other keys found in the first infer_rows records (in alphabetical order). If infer_rows=0, the columns are exactly fields_order. A record with a key that is not a column raises a ValueError.
+    csv_order_by allows to order rows according to the specified key, with an external merge sort (see external_sort()) keeping at most max_rows_in_memory records in memory.
+    The csv is written to a temporary file which then replaces output_file, so that an interrupted save never leaves a truncated csv."""
+    if isinstance(records, dict):
+        records = records.itervalues() if hasattr(records, 'itervalues') else records.values()
+    records = iter(records)
     # Define CSV fields order
     # If we were provided a fields_order list, we will show them first, else we create an empty fields_order
-    if fields_order is None:
-        fields_order = []
-    # Get dict/list values
-    if isinstance(d, dict):
-        dvals = d.values()
-    else:
-        dvals = d
-    # Then automatically add any other field (which order we don't care, they will be appended in alphabetical order)
+    fields_order = list(fields_order) if fields_order else []
+    # Then automatically add any other field of the first records (which order we don't care, they will be appended in alphabetical order)
+    head = list(itertools.islice(records, infer_rows))
     fields_order_check = set(fields_order)
-    for missing_field in sorted(dvals[0]):
+    for missing_field in sorted(set(itertools.chain.from_iterable(head))):
         if missing_field not in fields_order_check:
             fields_order.append(missing_field)
     if verbose:
         print('CSV fields order: '+str(fields_order))
+    records = itertools.chain(head, records)
+    # Reorder by name (or by any other column)
+    if csv_order_by is not None:
+        records = external_sort(records, lambda x: x[csv_order_by], max_rows_in_memory=max_rows_in_memory)
 
     # Write the csv
-    with open(output_file, 'wb') as f:  # Just use 'w' mode in 3.x
+    with _atomic_open(output_file) as f:
         w = csv.DictWriter(f, fields_order, delimiter=';')
         w.writeheader()
-        # Reorder by name (or by any other column)
-        if csv_order_by is not None:
-            d_generator = sorted(dvals, key=lambda x: x[csv_order_by])
-        else:
-            d_generator = dvals
-        # Walk the ordered list of dicts and write each as a row in the csv!
-        for d_fields in d_generator:
+        # Walk the ordered records and write each as a row in the csv!
+        for d_fields in records:
             w.writerow(d_fields)
     return True
 
 
-def save_df_as_csv(d, output_file, fields_order=None, csv_order_by=None, keep_index=False, encoding='utf-8-sig', blankna=False, excel=False, verbose=False, **kwargs):
-    """Save a dataframe in a csv
-    fields_order allows to precise what columns to put first (you don't need to specify all columns, only the ones you want first, the rest being alphabetically ordered). If None, alphabetical order will be used. If False, the original order will be used.
-    csv_order_by allows to order rows according to the alphabetical order of the specified column(s)
-    keep_index will save rows indices in the csv if True
-    blankna fills None, NaN and NaT with an empty string ''. This can be useful for 2 purposes: 1) more human readability, 2) pandas will more easily understand a field is empty, even if the correct datatype is not set (eg, datetime null value is NaT, but at loading the column will be type 'object' which means NaT values won't be considered null). Note however that if you want to use date_format or float_format or decimal options of pd.to_csv(), they will not work since the columns datatypes will be converted to object/string.
-    Encoding is by default 'utf-8-sig', which is UTF-8 with an encoding BOM in the file's header, this is necessary for Excel 2007 to correctly read the file (else it assumes latin-1): 
-    If excel is True, will save as an excel file (which better supports accentuated/special characters).
-    Combine with df_to_unicode() or df_to_unicode_fast() in case of encoding issues.
-    """
+def _df_csv_fields_order(d, fields_order=None, verbose=False):
+    """Return the list of columns in the order save_df_as_csv() writes them (see fields_order)"""
     # Define CSV fields order
     # If we were provided a fields_order list, we will show them first, else we create an empty fields_order
     if fields_order is None:
         fields_order = []
     elif fields_order is False:
         fields_order = d.columns
+    fields_order = list(fields_order)
     # Then automatically add any other field (which order we don't care, they will be appended in alphabetical order)
     fields_order_check = set(fields_order)
     for missing_field in sorted(d.columns):
         if missing_field not in fields_order_check:
             fields_order.append(missing_field)
+    if verbose:
+        print('CSV fields order: '+str(fields_order))
+    return fields_order
+
+def _df_csv_rows_order(d, csv_order_by=None, na_first=False):
+    """Return the positions of the rows of d in the order save_df_as_csv() writes them, ie, sorted according to csv_order_by (or by index), without copying the whole dataframe"""
+    if csv_order_by is not None:
+        keys = d[csv_order_by] if isinstance(csv_order_by, list) else d[[csv_order_by]]
+        return keys.reset_index(drop=True).sort_values(csv_order_by, na_position=('first' if na_first else 'last')).index.values
+    else:
+        return pd.Series(np.arange(len(d)), index=d.index).sort_index().values
+
+def _df_csv_reindex(d, fields_order, verbose=False):
+    """Reindex the columns of d according to fields_order (adding the columns that do not exist yet)"""
     try:
         d = d.reindex(columns=fields_order)  # Reindex in case we supplied an empty column
     except ValueError as exc:
         if verbose:
             print('Warning: ValueError raised: %s' % exc)
         pass
-    if verbose:
-        print('CSV fields order: '+str(fields_order))
-    # Blank none values
-    if blankna:
-        # Blank only non-datetime columns, else this will prevent reformatting on saving (because they will be considered as object/string and not date)
-        #cols_except_date = [col for col in d.columns if d[col].dtype.name != 'datetime64[ns]']
-        #d[cols_except_date] = d[cols_except_date].fillna('')
-        # Blank every null values
-        d = d.fillna('')
-        # replace also any null value hidden as a string
-        d[d.isna() | (d == 'None') | (d == 'NONE') | (d == 'none') | (d == 'NaN') | (d == 'nan') | (d == 'NaT') | (d == 'nat') | (d == 'na') | (d == 'NA') | (d == 'N/A')] = ''
+    return d
+
+def _df_csv_layout(d, fields_order=None, csv_order_by=None, na_first=False, verbose=False):
+    """Return the dataframe d laid out as save_df_as_csv() writes it, ie, with the columns reordered according to fields_order and the rows sorted according to csv_order_by (or by index), along with the list of columns"""
+    fields_order = _df_csv_fields_order(d, fields_order=fields_order, verbose=verbose)
+    rows_order = _df_csv_rows_order(d, csv_order_by=csv_order_by, na_first=na_first)
+    return _df_csv_reindex(d.iloc[rows_order], fields_order, verbose=verbose), fields_order
+
+# Null values hidden as strings, blanked by save_df_as_csv(blankna=True)
+_BLANKNA_STRINGS = frozenset(['None', 'NONE', 'none', 'NaN', 'nan', 'NaT', 'nat', 'na', 'NA', 'N/A'])
+
+def _blankna_mask(serie, strings=_BLANKNA_STRINGS):
+    """Boolean array of the null values of a Series, including the null values hidden as strings (any of strings, compared one by one, so that unhashable cells such as lists are supported)"""
+    mask = serie.isnull().values
+    if serie.dtype.name in ('object', 'string', 'str'):
+        mask = mask | np.array([isinstance(x, basestring) and x in strings for x in serie.values], dtype=bool)
+    return mask
+
+def _df_blankna_cols(d):
+    """Set of the names of the columns of d that have null values to blank (see _df_blankna())"""
+    return set(d.columns[pos] for pos in range(len(d.columns)) if _blankna_mask(d.iloc[:, pos]).any())
+
+def _df_blankna(d, cols=None):
+    """Fill None, NaN and NaT with an empty string '', as well as any null value hidden as a string, column by column.
+    Only the columns named in cols (by default the columns having null values, see _df_blankna_cols()) are blanked, and converted to object. Other columns keep their dtype (eg, datetime columns keep their formatting on saving), so that when saving by chunks, cols is computed once on the whole dataframe so that each column is written the same way in all chunks."""
+    if cols is None:
+        cols = _df_blankna_cols(d)
+    d = d.copy()
+    for pos in range(len(d.columns)):
+        if d.columns[pos] in cols:
+            serie = d.iloc[:, pos]
+            _df_set_column(d, pos, np.where(_blankna_mask(serie), '', serie.astype(object).values))
+    return d
+
+def _atomic_replace(src, dst):
+    """Move the file src to dst, replacing dst if it exists (atomically, except on Windows with Python 2)"""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2: os.rename() is atomic on POSIX but cannot replace an existing file on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+@contextmanager
+def _atomic_open(output_file, compress=False):
+    """Open a temporary file for writing in binary mode (gzipped if compress is True), which replaces output_file once closed, or is removed if an error occurs, so that output_file is never left half-written"""
+    tmp_file = '%s.%i.tmp' % (output_file, os.getpid())
+    try:
+        with (gzip.open(tmp_file, 'wb') if compress else open(tmp_file, 'wb')) as f:
+            yield f
+        _atomic_replace(tmp_file, output_file)
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
 
-    # Write the csv
-    if csv_order_by is not None:
-        d = d.sort_values(csv_order_by)
-    else:
-        d = d.sort_index()
-    if not excel:
-        if not output_file.endswith('.csv'):  # make sure the file extension is correct (else pandas will raise an error)
-            output_file += '.csv'
-        d.to_csv(output_file, sep=';', index=keep_index, columns=fields_order, encoding=encoding, **kwargs)
-    else:
+def _df_csv_chunk(chunk, columns, first=True, encoding='utf-8-sig', index=False, sep=';', **kwargs):
+    """Convert a chunk of a dataframe to encoded csv bytes, with the header only if it is the first chunk (and the byte order mark of the encoding, if any, only in the first chunk too). Any additional argument is passed to pd.to_csv()."""
+    if not first and encoding:
+        encoding = re.sub('[-_]sig$', '', encoding)
+    text = chunk.to_csv(None, sep=sep, index=index, header=first, columns=columns, encoding=encoding, **kwargs)
+    if isinstance(text, unicode):
+        text = text.encode(encoding or 'utf-8')
+    return text
+
+def save_df_as_csv(d, output_file, fields_order=None, csv_order_by=None, keep_index=False, encoding='utf-8-sig', blankna=False, excel=False, multivalue=False, compress=False, chunksize=10000, verbose=False, **kwargs):
+    """Save a dataframe in a csv
+    fields_order allows to precise what columns to put first (you don't need to specify all columns, only the ones you want first, the rest being alphabetically ordered). If None, alphabetical order will be used. If False, the original order will be used.
+    csv_order_by allows to order rows according to the alphabetical order of the specified column(s)
+    keep_index will save rows indices in the csv if True
+    blankna fills None, NaN and NaT with an empty string ''. This can be useful for 2 purposes: 1) more human readability, 2) pandas will more easily understand a field is empty, even if the correct datatype is not set (eg, datetime null value is NaT, but at loading the column will be type 'object' which means NaT values won't be considered null). Note however that if you want to use date_format or float_format or decimal options of pd.to_csv(), they will not work since the columns datatypes will be converted to object/string.
+    Encoding is by default 'utf-8-sig', which is UTF-8 with an encoding BOM in the file's header, this is necessary for Excel 2007 to correctly read the file (else it assumes latin-1): 
+    If excel is True, will save as an excel file (which better supports accentuated/special characters).
+    If multivalue is True, the multi-valued cells (lists, tuples and sets) are saved in the multi-value format (see serialize_multivalue()), so that they can be loaded back as lists by load_df_from_csv() (and df_literal_eval()). By default, they are saved in the legacy format (their Python representation, eg, ['a', 'b']), which is understood by older readers.
+    If compress is True (or if output_file ends with .csv.gz), the csv is gzipped, and .gz is appended to the filename.
+    The csv is written by chunks of chunksize rows (the columns reordering, multi-values serialization and blanking being done per chunk), so that the dataframe is never copied as a whole. It is written to a temporary file which then replaces output_file, so that an interrupted save never leaves a truncated csv.
+    Combine with df_to_unicode() or df_to_unicode_fast() in case of encoding issues.
+    """
+    if excel:
+        # Reorder the columns and sort the rows (null values first if they will be blanked, as empty strings would be sorted first)
+        d, fields_order = _df_csv_layout(d, fields_order=fields_order, csv_order_by=csv_order_by, na_first=blankna, verbose=verbose)
+        # Serialize the multi-valued cells
+        if multivalue:
+            d = df_serialize_multivalue(d)
+        # Blank none values
+        if blankna:
+            d = _df_blankna(d)
         if not output_file.endswith('.xls'):
             output_file += '.xls'
         d.to_excel(output_file, index=keep_index, columns=fields_order, encoding=encoding, **kwargs)
-    return True
+        return True
 
+    # Write the csv
+    if output_file.endswith('.csv.gz'):
+        compress = True
+        output_file = output_file[:-len('.gz')]
+    if not output_file.endswith('.csv'):  # make sure the file extension is correct
+        output_file += '.csv'
+    if compress:
+        output_file += '.gz'
+    # Compute the columns order and the rows order (null values first if they will be blanked, as empty strings would be sorted first) only once
+    fields_order = _df_csv_fields_order(d, fields_order=fields_order, verbose=verbose)
+    rows_order = _df_csv_rows_order(d, csv_order_by=csv_order_by, na_first=blankna)
+    # Columns to blank, on the whole dataframe, so that each column is written the same way whatever chunk its rows are in
+    blank_cols = _df_blankna_cols(d) if blankna else None
+    with _atomic_open(output_file, compress=compress) as f:
+        # Write at least the header, even if there is no row
+        for start in range(0, max(len(rows_order), 1), chunksize):
+            chunk = _df_csv_reindex(d.iloc[rows_order[start:start+chunksize]], fields_order, verbose=(verbose and start == 0))
+            # Serialize the multi-valued cells
+            if multivalue:
+                chunk = df_serialize_multivalue(chunk)
+            # Blank none values
+            if blankna:
+                chunk = _df_blankna(chunk, cols=blank_cols)
+            f.write(_df_csv_chunk(chunk, fields_order, first=(start == 0), encoding=encoding, index=keep_index, **kwargs))
+    return True
 
 def distance_jaccard_words(seq1, seq2, partial=False, norm=False, dist=0, minlength=0):
     """Jaccard distance on two lists of words. Any permutation is tested, so the resulting distance is insensitive to words order.
@@ -167,7 +335,7 @@ def distance_jaccard_words(seq1, seq2, partial=False, norm=False, dist=0, minlen
                 continue
             if s1 == s2 or \
             (partial and (s1.startswith(s2) or s2.startswith(s1))) or \
-            (dist and distance.nlevenshtein(s1, s2, method=1) <= dist):
+            (dist and distance.nlevenshtein_within(s1, s2, dist)):
                 count_eq += 1
                 del seq2_c[skey]
                 break
@@ -184,13 +352,15 @@ def distance_jaccard_words(seq1, seq2, partial=False, norm=False, dist=0, minlen
             # Return number of different words
             return count_total - count_eq
 
+WORDSPLIT_PATTERN = r'\s+|_+|,+|\.+|/+'  # do not split on -+| because - indicates a single word/name
+
 def distance_jaccard_words_split(s1, s2, *args, **kwargs):
     """Split sentences in words and call distance jaccard for words"""
     wordsplit_pattern = kwargs.get('wordsplit_pattern', None)
     if 'wordsplit_pattern' in kwargs:
         del kwargs['wordsplit_pattern']
     if not wordsplit_pattern:
-        wordsplit_pattern = r'\s+|_+|,+|\.+|/+';  # do not split on -+| because - indicates a single word/name
+        wordsplit_pattern = WORDSPLIT_PATTERN
 
     return distance_jaccard_words(re.split(wordsplit_pattern, s1), re.split(wordsplit_pattern, s2), *args, **kwargs)
 
@@ -245,40 +415,60 @@ def symbolic_copy(srcfile, dstfile):
 def sort_list_a_given_list_b(list_a, list_b):
     return sorted(list_a, key=lambda x: list_b.index(x))
 
-def replace_buggy_accents(s, encoding=None):
-    """Fix weird encodings that even ftfy cannot fix"""
-    # todo enhance speed? or is it the new regex on name?
-    dic_replace = {
-        '\xc4\x82\xc2\xa8': 'e',
-        'ĂŠ': 'e',
-        'Ăť': 'u',
-        'â': 'a',
-        'Ă´': 'o',
-        'Â°': '°',
-        'â': "'",
-        'ĂŞ': 'e',
-        'ÂŤ': '«',
-        'Âť': '»',
-        'Ă': 'a',
-        'AŠ': 'e',
-        'AŞ': 'e',
-        'A¨': 'e',
-        'A¨': 'e',
-        'Ă': 'E',
-        'â˘': '*',
-        'č': 'e',
-        '’': '\'',
-    }
-    # Convert the patterns to unicode if the input is a unicode string
-    if isinstance(s, unicode):
-        dic_replace = {k.decode('utf-8'): v.decode('utf-8') for k,v in dic_replace.items()}
-    # Replace each pattern with its correct counterpart
-    for pat, rep in dic_replace.items():
+# Weird encodings of accentuated characters that even ftfy cannot fix, and their replacement
+BUGGY_ACCENTS = {
+    '\xc4\x82\xc2\xa8': 'e',
+    'ĂŠ': 'e',
+    'Ăť': 'u',
+    'â': 'a',
+    'Ă´': 'o',
+    'Â°': '°',
+    'â': "'",
+    'ĂŞ': 'e',
+    'ÂŤ': '«',
+    'Âť': '»',
+    'Ă': 'a',
+    'AŠ': 'e',
+    'AŞ': 'e',
+    'A¨': 'e',
+    'A¨': 'e',
+    'Ă': 'E',
+    'â˘': '*',
+    'č': 'e',
+    '’': '\'',
+}
+
+# Compiled matchers of the buggy accents, built once per type of string and encoding (see _buggy_accents_matcher())
+_buggy_accents_matchers = {}
+
+def _buggy_accents_matcher(isunicode=False, encoding=None):
+    """Build (once) the matcher of the buggy accents for str or unicode strings and the given encoding: a single regex alternation of all the patterns, longest first so that a pattern is always preferred to its prefixes, and the dict of their replacements"""
+    key = (isunicode, encoding)
+    if key not in _buggy_accents_matchers:
+        dic_replace = BUGGY_ACCENTS
+        # Convert the patterns to unicode if the input is a unicode string
+        if isunicode:
+            dic_replace = {k.decode('utf-8'): v.decode('utf-8') for k,v in dic_replace.items()}
         if encoding:
-            pat = pat.decode(encoding)
-            rep = rep.decode(encoding)
-        s = s.replace(pat, rep)
-    return s
+            dic_replace = {k.decode(encoding): v.decode(encoding) for k,v in dic_replace.items()}
+        regex = re.compile('|'.join(re.escape(pat) for pat in sorted(dic_replace, key=len, reverse=True)))
+        _buggy_accents_matchers[key] = (regex, dic_replace)
+    return _buggy_accents_matchers[key]
+
+def replace_buggy_accents(s, encoding=None):
+    """Fix weird encodings that even ftfy cannot fix (see BUGGY_ACCENTS), in a single pass over the string"""
+    regex, dic_replace = _buggy_accents_matcher(isinstance(s, unicode), encoding)
+    return regex.sub(lambda m: dic_replace[m.group(0)], s)
+
+def replace_buggy_accents_serie(serie, encoding=None):
+    """Apply replace_buggy_accents() on a whole Series (or list) of strings, fixing each distinct string only once. Other values (eg, null) are kept as-is."""
+    if not isinstance(serie, pd.Series):
+        serie = pd.Series(serie)
+    mapping = {}
+    for x in serie.values:
+        if isinstance(x, basestring) and (type(x), x) not in mapping:
+            mapping[(type(x), x)] = replace_buggy_accents(x, encoding=encoding)
+    return pd.Series([(mapping[(type(x), x)] if isinstance(x, basestring) else x) for x in serie.values], index=serie.index, dtype='object')
 
 def cleanup_name(s, encoding=None, normalize=True, clean_nonletters=True):
     """Clean a name and remove accentuated characters"""
@@ -295,16 +485,247 @@ def cleanup_name(s, encoding=None, normalize=True, clean_nonletters=True):
         s = re.sub('\-+', '-', re.sub('\s+', ' ', re.sub('[^a-zA-Z0-9\-]', ' ', s))).strip().replace('\r', '').replace('\n', '').replace('\t', '').replace(',', ' ').replace('  ', ' ').strip()  # clean up spaces, punctuation and double dashes in name
     return s
 
+class LRUCache(object):
+    """Bounded memoization cache, evicting the least recently used entries when full, and counting hits and misses"""
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Get the value stored for key (and mark it as recently used), or default if there is none"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value  # reinsert at the end, as the most recently used
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if the cache is full"""
+        if key in self._data:
+            del self._data[key]
+        elif self.maxsize is not None:
+            while len(self._data) >= self.maxsize and self._data:
+                self._data.popitem(last=False)
+        self._data[key] = value
+
+    def discard(self, key):
+        """Remove the value stored for key, if any"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dict of the cache statistics (hits, misses, current size and maximum size)"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+# Cache of normalized names, shared by all the names processing functions (merge_two_df(), compute_names_distance_matrix(), cleanup_name_df(), etc)
+_names_cache = LRUCache(maxsize=200000)
+_nocache = object()  # sentinel for cache misses
+
+def normalize_name(s, encoding=None, normalize=True, clean_nonletters=True, fix_accents=True):
+    """Memoized name normalization, equivalent to cleanup_name(replace_buggy_accents(s)) (or only cleanup_name(s) if fix_accents=False).
+    The results are stored in a bounded LRU cache shared by all the names processing functions of this module, so that each name is only normalized once (including charset detection), see names_cache_stats()."""
+    key = (type(s), s, encoding, normalize, clean_nonletters, fix_accents)
+    try:
+        res = _names_cache.get(key, _nocache)
+    except TypeError:
+        # Unhashable input, we cannot cache it
+        key = None
+        res = _nocache
+    if res is _nocache:
+        res = cleanup_name(replace_buggy_accents(s) if fix_accents else s, encoding=encoding, normalize=normalize, clean_nonletters=clean_nonletters)
+        if key is not None:
+            _names_cache.set(key, res)
+    return res
+
+def normalize_names(serie, **kwargs):
+    """Normalize a whole Series (or list) of names with normalize_name(), normalizing each distinct value only once. Null values are kept as-is.
+    Any additional argument is passed to normalize_name()."""
+    if not isinstance(serie, pd.Series):
+        serie = pd.Series(serie)
+    mapping = {x: normalize_name(x, **kwargs) for x in serie.dropna().unique()}
+    # Not with serie.map(), which would turn None into NaN
+    return pd.Series([(mapping[x] if notnull else x) for x, notnull in zip(serie.values, serie.notnull().values)], index=serie.index, name=serie.name, dtype='object')
+
+def cleanup_names(serie, encoding=None, normalize=True, clean_nonletters=True, fix_accents=False, min_confidence=0.9):
+    """Vectorized cleanup_name() over a whole Series (or list) of names: each distinct name is cleaned only once, and the regex steps are applied on all distinct names at once with Series.str methods. Non string values (eg, null) are kept as-is.
+    If encoding is None, each str name is first decoded as strict UTF-8 (which almost never succeeds on another encoding), and the encoding of the remaining names is detected once for all of them (see detect_encoding()) instead of for each string. If this detection is less confident than min_confidence, or if a name cannot be decoded with it, the name falls back to a per-string detection as in cleanup_name(), so that a single-byte encoding (eg, ISO-8859-1, which decodes anything) is never applied on UTF-8 names.
+    If fix_accents=True, replace_buggy_accents() is applied first, as in normalize_name()."""
+    if not isinstance(serie, pd.Series):
+        serie = pd.Series(serie)
+    # Distinct names, keyed by type since a str and a unicode string can compare equal but be cleaned differently
+    keys = []
+    seen = set()
+    for x in serie.values:
+        if isinstance(x, basestring) and (type(x), x) not in seen:
+            seen.add((type(x), x))
+            keys.append((type(x), x))
+    names = [(replace_buggy_accents(x) if fix_accents else x) for _, x in keys]
+    # Decode the str names
+    if encoding is not None:
+        decoded = [(s if isinstance(s, unicode) else s.decode(encoding)) for s in names]
+    else:
+        decoded = list(names)
+        remaining = []
+        for i, s in enumerate(names):
+            if not isinstance(s, unicode):
+                try:
+                    decoded[i] = s.decode('utf-8')
+                except UnicodeDecodeError:
+                    remaining.append(i)
+        # One encoding detection for all the names that are not UTF-8
+        column_encoding, confidence = detect_encoding([names[i] for i in remaining], with_confidence=True)
+        if confidence < min_confidence:
+            column_encoding = None
+        for i in remaining:
+            s = names[i]
+            if column_encoding:
+                try:
+                    decoded[i] = s.decode(column_encoding)
+                    continue
+                except UnicodeDecodeError:
+                    pass
+            # Per-string detection, as in cleanup_name()
+            s_encoding = chardet.detect(s)['encoding']
+            if s_encoding:
+                decoded[i] = s.decode(s_encoding)
+    cleaned = pd.Series([_unidecode(s.replace('^', ' ')) for s in decoded], dtype='object')
+    if normalize:
+        cleaned = cleaned.str.lower().str.strip()
+    if clean_nonletters:
+        # Same steps as cleanup_name(), minus the replacements of \r, \n, \t, commas and double spaces which are already removed by the first two regexes
+        cleaned = cleaned.str.replace('[^a-zA-Z0-9\-]', ' ', regex=True).str.replace('\s+', ' ', regex=True).str.replace('\-+', '-', regex=True).str.strip()
+    mapping = dict(zip(keys, cleaned.values))
+    return pd.Series([(mapping[(type(x), x)] if isinstance(x, basestring) else x) for x in serie.values], index=serie.index, dtype='object')
+
+def names_cache_stats():
+    """Return the statistics (hits, misses, size, maxsize) of the shared names normalization cache"""
+    return _names_cache.stats()
+
+def names_cache_clear(maxsize=None):
+    """Empty the shared names normalization cache, and optionally change its maximum size"""
+    _names_cache.clear()
+    if maxsize is not None:
+        _names_cache.maxsize = maxsize
+
+# Default order of the diagnoses, from least to best
+DIAG_ORDER = ['coma', 'vs/uws', 'mcs', 'mcs-', 'mcs+', 'emcs', 'lis']
+
+class DiagnosisScale(object):
+    """Ordinal scale of diagnoses, built once from diag_order (from least to best, case insensitive), to encode whole columns of diagnoses into small integer codes (the rank in diag_order, -1 for null values) and compute the best or worst diagnosis per subject (or per subject and date, etc) at once, instead of calling compute_best_diag() on each row.
+    Cells can be single diagnoses or multi-valued (lists, or strings in the multi-value format, see parse_multivalue())."""
+    def __init__(self, diag_order=None):
+        if diag_order is None:
+            diag_order = DIAG_ORDER
+        self.labels = [x.lower().strip() for x in diag_order]
+        self.codes = dict((label, i) for i, label in enumerate(self.labels))
+        self.dtype = pd.api.types.CategoricalDtype(categories=self.labels, ordered=True)
+        self._labels_array = np.array(self.labels + [None], dtype='object')  # code -1 is decoded as None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def encode_value(self, x):
+        """Encode one cell: return the code of a diagnosis, -1 if null, or the list of codes if multi-valued. Raise a ValueError if a diagnosis is not in the scale."""
+        if isinstance(x, basestring):
+            x = parse_multivalue(x)
+        if isinstance(x, (list, tuple, set)):
+            return [self.encode_value(y) for y in x]
+        if not isinstance(x, basestring):
+            # Null or another type (the same as compute_best_diag())
+            return -1
+        try:
+            return self.codes[x.lower().strip()]
+        except KeyError:
+            raise ValueError('The provided list of diagnosis does not cover all possible diagnosis in database. Please fix the list. Unknown diagnosis: %s' % x)
+
+    def encode(self, serie, reduce=None):
+        """Encode a whole Series of diagnoses into codes, each distinct value being encoded only once. The multi-valued cells are exploded into one row per value (with the same index), or reduced to one code if reduce is 'max' (best) or 'min' (worst)."""
+        if not isinstance(serie, pd.Series):
+            serie = pd.Series(serie)
+        mapping = {}
+        multi = False
+        for x in serie.values:
+            try:
+                if x in mapping:
+                    continue
+            except TypeError:
+                # Unhashable, eg a list
+                multi = True
+                continue
+            code = self.encode_value(x)
+            mapping[x] = code
+            multi = multi or isinstance(code, list)
+        if not multi:
+            return pd.Series([mapping[x] for x in serie.values], index=serie.index, dtype='int64')
+        codes = [mapping[x] if not isinstance(x, (list, tuple, set)) else self.encode_value(x) for x in serie.values]
+        if reduce is not None:
+            # Reduce the multi-valued cells to one code, ignoring null values
+            func = max if reduce == 'max' else min
+            codes = [(func([y for y in c if y >= 0] or [-1]) if isinstance(c, list) else c) for c in codes]
+            return pd.Series(codes, index=serie.index, dtype='int64')
+        # Explode the multi-valued cells into one row per value
+        positions = [i for i, c in enumerate(codes) for _ in (c if isinstance(c, list) and c else [c])]
+        values = [y for c in codes for y in (c if isinstance(c, list) and c else [-1 if isinstance(c, list) else c])]
+        return pd.Series(values, index=serie.index[positions], dtype='int64')
+
+    def decode(self, codes):
+        """Decode a Series (or array) of codes back into diagnoses labels (None for -1)"""
+        if isinstance(codes, pd.Series):
+            return pd.Series(self._labels_array[codes.values.astype('int64')], index=codes.index, dtype='object')
+        return self._labels_array[np.asarray(codes, dtype='int64')]
+
+    def categorical(self, serie):
+        """Convert a Series of single diagnoses into an ordered categorical Series (same as compute_best_diag(persubject=None))"""
+        return serie.str.lower().str.strip().astype(self.dtype)
+
+    def _reduce(self, serie, level, func):
+        """Reduce the diagnoses with func ('max' or 'min') per cell or per group of the index level(s)"""
+        if level is None:
+            # Reduce each cell
+            return self.decode(self.encode(serie, reduce=func))
+        # Reduce per group of the given index level(s), ignoring null values
+        codes = self.encode(serie)
+        groups = serie.groupby(level=level).size().index
+        res = getattr(codes[codes >= 0].groupby(level=level), func)().reindex(groups).fillna(-1)
+        return self.decode(res)
+
+    def best(self, serie, level=0):
+        """Best diagnosis per group of the index level(s) (eg, 0 for per subject, [0, 1] for per subject and date), or per cell if level is None. Returns a Series of labels, None if there is no diagnosis."""
+        return self._reduce(serie, level, 'max')
+
+    def worst(self, serie, level=0):
+        """Worst diagnosis per group of the index level(s), or per cell if level is None, see best()"""
+        return self._reduce(serie, level, 'min')
+
 # Compute best diagnosis for each patient
 def compute_best_diag(serie, diag_order=None, persubject=True):
     """Convert a serie to a categorical type and extract the best diagnosis for each subject (patient name must be set as index level 0)
     Note: case insensitive and strip spaces automatically
+    diag_order can also be a DiagnosisScale, which is much faster to process whole columns at once (see DiagnosisScale.best() and DiagnosisScale.worst()).
     Set persubject to None if you want to do the max or min yourself (this will return the Series configured with discrete datatype),
     in this case, do NOT use `max(compute_best_diag(etc..))`, which will output a random value, but rather `compute_best_diag(etc..).max()` (pandas max instead of python native max) which will give you the correct maximum given your specified diag_order."""
     if isinstance(serie, basestring):
         return serie
     if diag_order is None:
-        diag_order = ['coma', 'vs/uws', 'mcs', 'mcs-', 'mcs+', 'emcs', 'lis']  # from least to best
+        diag_order = DIAG_ORDER
+    elif isinstance(diag_order, DiagnosisScale):
+        diag_order = diag_order.labels
     # Convert to lowercase
     diag_order = [x.lower().strip() for x in diag_order]
     # Convert to a serie if given a simple list (which will give us access to CategoricalDtype) or if None (so that the rest of the function can work and return an expected Series)
@@ -343,7 +764,586 @@ def ordereddict_change_key(d, old, new):
         d2[new if old == k else k] = v
     return d2
 
-def merge_two_df(df1, df2, col='Name', dist_threshold=0.2, dist_words_threshold=0.4, mode=0, skip_sanity=False, keep_nulls=True, returnmerged=False, keep_lastname_only=False, prependcols=None, fillna=False, fillna_exclude=None, join_on_shared_keys=True, squish=True, verbose=False, **kwargs):
+def edit_budget(dist_threshold, length):
+    """Maximum number of edits between two sequences, the longest being of the given length, so that their normalized levenshtein distance (method=1) stays below or equal to dist_threshold. Returns -1 if no distance can satisfy the threshold."""
+    if length <= 0:
+        return 0
+    k = min(length, max(0, int(dist_threshold * length) + 1))
+    # Use the same float division as distance.nlevenshtein() to avoid any rounding discrepancy
+    while k >= 0 and k / float(length) > dist_threshold:
+        k -= 1
+    return k
+
+def qgrams_keys(s, q=2):
+    """Extract the q-grams of a string as keys numbered by occurrence (eg, 'aaa' gives ('aa', 0), ('aa', 1)), so that the size of the intersection of two sets of keys is the size of the multiset intersection of their q-grams"""
+    seen = {}
+    keys = []
+    for i in range(len(s) - q + 1):
+        g = s[i:i+q]
+        n = seen.get(g, 0)
+        seen[g] = n + 1
+        keys.append((g, n))
+    return keys
+
+def qgram_index_build(items, q=2):
+    """Build an inverted index of q-grams over a list of strings, to quickly find which strings may be similar to a query string, see qgram_index_query()"""
+    index = {'q': q, 'grams': {}, 'lengths': {}, 'exact': {}, 'lens': [len(s) for s in items]}
+    for i, s in enumerate(items):
+        index['lengths'].setdefault(len(s), []).append(i)
+        index['exact'].setdefault(s, []).append(i)
+        for key in qgrams_keys(s, q):
+            index['grams'].setdefault(key, []).append(i)
+    return index
+
+def qgram_index_query(index, s, dist_threshold):
+    """Find the ids of the strings in a q-grams index that may be at a normalized levenshtein distance (method=1) below or equal to dist_threshold from s.
+    This is a lossless filter: every string passing the threshold is returned, but some returned strings may not, so candidates still need to be checked with the real distance.
+    It relies on the lengths difference and on the count of shared q-grams, which must be at least max(len1, len2) - q + 1 - k*q for k edits (Ukkonen's q-gram lemma)."""
+    q = index['q']
+    la = len(s)
+    budgets = {}
+    def get_budget(lb):
+        L = max(la, lb)
+        if L not in budgets:
+            budgets[L] = edit_budget(dist_threshold, L)
+        return budgets[L]
+    candidates = set()
+    # Short strings might match without sharing any q-gram, these need to be added whole
+    for lb, ids in index['lengths'].items():
+        k = get_budget(lb)
+        if k < 0 or abs(la - lb) > k:
+            continue
+        if max(la, lb) - q + 1 - k*q <= 0:
+            if k == 0:
+                # No edit allowed, only an exact match can pass
+                candidates.update(index['exact'].get(s, []) if lb == la else [])
+            else:
+                candidates.update(ids)
+    # Count filtering on shared q-grams for all the other strings
+    counts = {}
+    for key in qgrams_keys(s, q):
+        for i in index['grams'].get(key, []):
+            counts[i] = counts.get(i, 0) + 1
+    lens = index['lens']
+    for i, count in counts.items():
+        lb = lens[i]
+        k = get_budget(lb)
+        if k >= 0 and abs(la - lb) <= k and count >= max(la, lb) - q + 1 - k*q:
+            candidates.add(i)
+    return candidates
+
+def build_names_blocking_index(names, q=2, wordsplit_pattern=None):
+    """Build a blocking index over a list of (already cleaned up) names, indexing q-grams of whole names and of their words, see blocking_candidates()"""
+    if not wordsplit_pattern:
+        wordsplit_pattern = WORDSPLIT_PATTERN
+    vocab = OrderedDict()  # word -> ids of the names containing this word
+    for i, name in enumerate(names):
+        for word in filter(None, re.split(wordsplit_pattern, name)):
+            vocab.setdefault(word, set()).add(i)
+    return {'count': len(names),
+            'names': qgram_index_build(names, q=q),
+            'words': qgram_index_build(list(vocab.keys()), q=q),
+            'words_names': list(vocab.values()),
+            'wordsplit_pattern': wordsplit_pattern,
+           }
+
+def blocking_candidates(index, name, dist_threshold=0.2, dist_words_threshold=0.4, mode=0, dist_words=None):
+    """Find the ids of the names in a blocking index (see build_names_blocking_index()) that may be similar to the provided (cleaned up) name, given the same tests as merge_two_df(): normalized levenshtein distance on the whole names <= dist_threshold, and/or normalized jaccard words distance (with fuzzy words matching at dist_words, by default dist_threshold, and no partial matching) <= dist_words_threshold.
+    mode=0 is or test, 1 is and test, as in merge_two_df().
+    This is lossless: no name passing the tests can be missed, so the result is the same as an exhaustive comparison, but much faster.
+    The index can also be a NameIndex mapped on a list of names with NameIndex.mapped()."""
+    if 'nameindex' in index:
+        # Prebuilt NameIndex: the names that are not in the NameIndex are always candidates
+        ids = set(index['unindexed'])
+        for cname in index['nameindex'].candidates(name, dist_threshold, dist_words_threshold, mode=mode, dist_words=dist_words):
+            ids.update(index['positions'].get(cname, []))
+        return ids
+    if dist_words is None:
+        dist_words = dist_threshold
+    # Character-wise test on the whole name
+    cands_chars = qgram_index_query(index['names'], name, dist_threshold)
+    # Words-wise test: a normalized jaccard distance below 1.0 requires at least one pair of words to match
+    if dist_words_threshold >= 1.0:
+        cands_words = set(range(index['count']))
+    else:
+        cands_words = set()
+        for word in set(filter(None, re.split(index['wordsplit_pattern'], name))):
+            for wid in qgram_index_query(index['words'], word, dist_words):
+                cands_words.update(index['words_names'][wid])
+    if mode == 1:
+        return cands_chars & cands_words
+    else:
+        return cands_chars | cands_words
+
+class WordsJaccardMatcher(object):
+    """Batch computation of distance_jaccard_words_split() between any name and the names of a fixed list (eg, all the names of a database), giving exactly the same results.
+    Each name of the list is split in words only once, and the words are indexed in a vocabulary. The matching words (equal, or starting with each other if partial=True, or within the fuzzy distance dist) of each queried word are found once for the whole vocabulary (using a q-grams index for the fuzzy matching) and cached, so that each pair of names is then scored by a greedy matching over small lists of word ids, without any new string comparison."""
+    def __init__(self, names, partial=False, norm=False, dist=0, minlength=0, wordsplit_pattern=None):
+        self.partial = partial
+        self.norm = norm
+        self.dist = dist
+        self.minlength = minlength
+        self.wordsplit_pattern = wordsplit_pattern if wordsplit_pattern else WORDSPLIT_PATTERN
+        self.vocab = OrderedDict()  # word -> word id
+        self.names_words = []  # for each name, the tuple of its words ids
+        for name in names:
+            self.names_words.append(tuple(self.vocab.setdefault(w, len(self.vocab)) for w in self.split(name)))
+        self.words = list(self.vocab.keys())
+        self.words_sorted = sorted(self.words)  # for partial matching by prefix
+        self.words_index = qgram_index_build(self.words) if dist else None
+        self.cache = {}  # queried word -> frozenset of the matching words ids
+
+    def split(self, name):
+        """Split a name in words, as distance_jaccard_words_split() (a None name has no words)"""
+        if name is None:
+            return []
+        return filter(None, re.split(self.wordsplit_pattern, name))
+
+    def match_word(self, word):
+        """Find the ids of all the words in the vocabulary matching the provided word, as a frozenset (cached)"""
+        res = self.cache.get(word)
+        if res is not None:
+            return res
+        minlength = self.minlength
+        matches = set()
+        if not minlength or len(word) >= minlength:
+            if word in self.vocab:
+                matches.add(self.vocab[word])
+            if self.partial:
+                # Words of the vocabulary starting with this word
+                i = bisect.bisect_left(self.words_sorted, word)
+                while i < len(self.words_sorted) and self.words_sorted[i].startswith(word):
+                    matches.add(self.vocab[self.words_sorted[i]])
+                    i += 1
+                # Words of the vocabulary this word starts with
+                for k in range(1, len(word)):
+                    if word[:k] in self.vocab:
+                        matches.add(self.vocab[word[:k]])
+            if self.dist:
+                for wid in qgram_index_query(self.words_index, word, self.dist):
+                    if distance.nlevenshtein_within(word, self.words[wid], self.dist):
+                        matches.add(wid)
+            if minlength:
+                matches = set(wid for wid in matches if len(self.words[wid]) >= minlength)
+        res = frozenset(matches)
+        self.cache[word] = res
+        return res
+
+    def distance(self, name1, nameid2):
+        """Compute distance_jaccard_words_split(name1, names[nameid2]) with the parameters of this matcher"""
+        words1 = self.split(name1)
+        words2 = self.names_words[nameid2]
+        count_total = len(words1) + len(words2)
+        count_eq = 0
+        used = [False] * len(words2)
+        for w1 in words1:
+            matches = self.match_word(w1)
+            if not matches:
+                continue
+            # Greedy matching: take the first word not yet matched, in order
+            for k, w2 in enumerate(words2):
+                if not used[k] and w2 in matches:
+                    used[k] = True
+                    count_eq += 1
+                    break
+        # Prepare the result to return, same as distance_jaccard_words()
+        if self.norm is None:
+            return count_eq
+        else:
+            count_eq *= 2
+            if self.norm:
+                return 1.0 - (float(count_eq) / count_total)
+            else:
+                return count_total - count_eq
+
+PAIRS_CACHE_VERSION = 1  # increment whenever the names cleanup or the distances computation change, to invalidate the old cached pairs
+
+class PairsCache(object):
+    """On-disk cache (SQLite) of the character-wise (normalized levenshtein) and words-wise (jaccard) distances between pairs of cleaned up names, so that repeated merges of the same databases only compute the pairs they have not seen before.
+    The pairs are keyed by both names and a parameters string (see PairsCache.params()) that includes the words matching parameters and PAIRS_CACHE_VERSION.
+    The new pairs and the usage of the cached pairs are kept in memory and only written on flush() (also automatically every autoflush new pairs), in one short transaction, so that several processes can share the same cache file (the database is in WAL mode, so that readers do not block the writer).
+    A connection cannot be shared across processes: each process must open its own PairsCache on the same path (pickling a PairsCache, eg to send it to a spawned process, opens a new connection).
+    The number of stored pairs is capped by maxsize: when it is exceeded, the least recently used pairs are evicted on flush() or close() (if maxsize is None, pairs are never evicted). Statistics are available with stats()."""
+    def __init__(self, path, maxsize=10000000, timeout=60.0, autoflush=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.autoflush = autoflush
+        self.hits = 0
+        self.misses = 0
+        self._open()
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError:
+            # WAL is not supported on this filesystem (eg, network drives), keep the default rollback journal
+            pass
+        self._new_pairs = {}  # (params, name1) -> {name2: (dchars, dwords)}, not yet written
+        self._used_pairs = set()  # (params, name1, name2) of the cached pairs used since the last flush
+        self._new_count = 0
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pairs (params TEXT, name1 TEXT, name2 TEXT, dchars REAL, dwords REAL, last_used INTEGER, PRIMARY KEY (params, name1, name2))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pairs_last_used ON pairs (last_used)')
+        self.conn.commit()
+        # Logical clock to track the least recently used pairs, continuing from the last run
+        self.clock = (self.conn.execute('SELECT MAX(last_used) FROM pairs').fetchone()[0] or 0) + 1
+
+    def __getstate__(self):
+        # The SQLite connection cannot be pickled (eg, to send to a worker process), the copy will open its own connection (and starts with no pending pairs)
+        state = self.__dict__.copy()
+        for key in ('conn', '_new_pairs', '_used_pairs', '_new_count'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+
+    @staticmethod
+    def params(dist=0, norm=True, minlength=0, partial=False):
+        """Build the parameters string of the cached pairs, from the parameters of the words-wise distance"""
+        return 'v%i;dist=%r;norm=%r;minlength=%r;partial=%r' % (PAIRS_CACHE_VERSION, dist, norm, minlength, partial)
+
+    def distances(self, name1, items, compute, params):
+        """Get the (character-wise, words-wise) distances between name1 and each name of items, a list of (id, name2). Only the pairs absent from the cache are computed with compute(id, name2) and then stored. Returns the list of distances in the same order as items."""
+        cached = dict(((name2, (dchars, dwords)) for name2, dchars, dwords in self.conn.execute('SELECT name2, dchars, dwords FROM pairs WHERE params=? AND name1=?', (params, name1))))
+        new_pairs = self._new_pairs.setdefault((params, name1), {})
+        res = []
+        for i, name2 in items:
+            dists = new_pairs.get(name2)
+            if dists is None:
+                dists = cached.get(name2)
+                if dists is None:
+                    dists = compute(i, name2)
+                    new_pairs[name2] = dists
+                    self._new_count += 1
+                    self.misses += 1
+                else:
+                    self._used_pairs.add((params, name1, name2))
+                    self.hits += 1
+            else:
+                self.hits += 1
+            res.append(dists)
+        if self.autoflush and self._new_count >= self.autoflush:
+            self.flush()
+        return res
+
+    def flush(self):
+        """Write the new pairs and the usage of the cached pairs to disk in one transaction, and evict the least recently used pairs if the cache is above maxsize"""
+        with self.conn:
+            # Continue from the latest flush of any process sharing the cache
+            self.clock = max(self.clock, (self.conn.execute('SELECT MAX(last_used) FROM pairs').fetchone()[0] or 0)) + 1
+            if self._used_pairs:
+                self.conn.executemany('UPDATE pairs SET last_used=? WHERE params=? AND name1=? AND name2=?', ((self.clock, params, name1, name2) for params, name1, name2 in self._used_pairs))
+            if self._new_pairs:
+                self.conn.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)', ((params, name1, name2, dists[0], dists[1], self.clock) for (params, name1), new_pairs in self._new_pairs.items() for name2, dists in new_pairs.items()))
+            if self.maxsize is not None:
+                excess = len(self) - self.maxsize
+                if excess > 0:
+                    self.conn.execute('DELETE FROM pairs WHERE rowid IN (SELECT rowid FROM pairs ORDER BY last_used LIMIT ?)', (excess,))
+        self._new_pairs = {}
+        self._used_pairs = set()
+        self._new_count = 0
+
+    def close(self):
+        """Flush and close the cache"""
+        self.flush()
+        self.conn.close()
+
+    def clear(self):
+        """Delete all the cached pairs and reset the counters"""
+        self.conn.execute('DELETE FROM pairs')
+        self.conn.commit()
+        self._new_pairs = {}
+        self._used_pairs = set()
+        self._new_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dict of the cache statistics (hits and misses of this session, number of stored pairs and maximum size)"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self), 'maxsize': self.maxsize}
+
+# Stages of the matching cascade of find_similar_names(), from the cheapest to the most expensive test
+MATCH_CASCADE_STAGES = ('exact', 'length', 'fastcomp', 'levenshtein', 'words')
+
+def _cascade_decision(testsim1, testsim2, mode):
+    """Return the outcome of the similarity test of a pair of names (True or False) given the outcome of the character-wise and words-wise tests (None if not computed yet), or None if it is not decided yet"""
+    if mode == 0:
+        if testsim1 or testsim2:
+            return True
+        if testsim1 is False and testsim2 is False:
+            return False
+    elif mode == 1:
+        if testsim1 is False or testsim2 is False:
+            return False
+        if testsim1 and testsim2:
+            return True
+    else:
+        return False
+    return None
+
+def match_names_cascade(name1, name2, nameid2=None, dist_threshold=0.2, dist_words_threshold=0.4, mode=0, stages=MATCH_CASCADE_STAGES, words_matcher=None, dist_chars=None, stats=None):
+    """Test if two (cleaned up) names are similar, with the same tests as merge_two_df(), by running the stages of a cascade of tests from the cheapest to the most expensive and stopping as soon as the outcome is decided (given the mode, 0 for or test, 1 for and test):
+    'exact' (names equality), 'length' (length difference above the maximum number of edits), 'fastcomp' (distance.fast_comp() for up to 2 edits), 'levenshtein' (distance.nlevenshtein_within()) and 'words' (words-wise jaccard distance, using words_matcher and the id nameid2 of name2 in it if provided).
+    stages can be any subset of MATCH_CASCADE_STAGES in any order, 'levenshtein' and 'words' are run last if they are missing and the outcome is not decided yet. If dist_chars is provided, it is used as the precomputed character-wise distance.
+    If a stats dict is provided, the number of pairs decided by each stage is accumulated in it."""
+    testsim1 = None if dist_chars is None else bool(dist_chars <= dist_threshold)
+    testsim2 = None
+    longest = None
+    res = _cascade_decision(testsim1, testsim2, mode)
+    if res is not None:
+        if stats is not None:
+            stats['levenshtein'] = stats.get('levenshtein', 0) + 1
+        return res
+    for stage in itertools.chain(stages, ('levenshtein', 'words')):
+        if stage == 'words':
+            if testsim2 is not None:
+                continue
+            if words_matcher is not None and nameid2 is not None:
+                testsim2 = words_matcher.distance(name1, nameid2) <= dist_words_threshold
+            else:
+                testsim2 = distance_jaccard_words_split(name1, name2, partial=False, norm=True, dist=dist_threshold) <= dist_words_threshold
+        elif testsim1 is not None:
+            continue
+        elif stage == 'exact':
+            if name1 == name2:
+                testsim1 = 0.0 <= dist_threshold
+        elif stage == 'length' or stage == 'fastcomp':
+            if longest is None:
+                longest = max(len(name1), len(name2))
+                max_edits = edit_budget(dist_threshold, longest)
+            if longest == 0:
+                continue
+            if stage == 'length':
+                if abs(len(name1) - len(name2)) > max_edits:
+                    testsim1 = False
+            else:
+                d = distance.fast_comp(name1, name2)
+                if d >= 0:
+                    testsim1 = d <= max_edits
+                elif max_edits < 3:
+                    # fast_comp() failed, so there are at least 3 edits
+                    testsim1 = False
+        elif stage == 'levenshtein':
+            testsim1 = distance.nlevenshtein_within(name1, name2, dist_threshold)
+        else:
+            raise ValueError('Unknown cascade stage: %s' % stage)
+        res = _cascade_decision(testsim1, testsim2, mode)
+        if res is not None:
+            if stats is not None:
+                stats[stage] = stats.get(stage, 0) + 1
+            return res
+    return False
+
+def find_similar_names(name1, names2, blocking_index=None, dist_threshold=0.2, dist_words_threshold=0.4, mode=0, batch=False, words_matcher=None, pairs_cache=None, cascade=MATCH_CASCADE_STAGES, cascade_stats=None):
+    """Find the ids of all the (cleaned up) names in the list names2 that are similar to the (cleaned up) name1, using the same tests as merge_two_df(). Names that are None in names2 are skipped.
+    If a blocking_index is provided (see build_names_blocking_index()), only the candidates it returns are compared. If batch=True, the character-wise distances are computed all at once with distance.nlevenshtein_many().
+    If a words_matcher is provided, it must be a WordsJaccardMatcher(names2, partial=False, norm=True, dist=dist_threshold), which will be used to compute the words-wise distances.
+    If a pairs_cache is provided (see PairsCache), the distances of the pairs already seen are read from it, and only the new pairs are computed.
+    Else, each pair is tested with match_names_cascade() using the given cascade stages, and the number of pairs decided by each stage is accumulated in the cascade_stats dict if provided."""
+    if blocking_index is not None:
+        # Compare only with the candidates found by blocking (in the same order as names2)
+        candidates = sorted(blocking_candidates(blocking_index, name1, dist_threshold, dist_words_threshold, mode=mode))
+    else:
+        candidates = range(len(names2))
+    if batch:
+        # Compute the character-wise distances against all candidates at once
+        dists_chars = distance.nlevenshtein_many(name1, [names2[i] or '' for i in candidates])
+    found = []
+    if pairs_cache is not None:
+        # Use the cached distances, and compute the full distances of the new pairs only
+        positions = dict((i, k) for k, i in enumerate(candidates)) if batch else None
+        def compute_pair(i, name2):
+            dchars = dists_chars[positions[i]] if batch else distance.nlevenshtein(name1, name2, method=1)
+            dwords = words_matcher.distance(name1, i) if words_matcher is not None else distance_jaccard_words_split(name1, name2, partial=False, norm=True, dist=dist_threshold)
+            return (dchars, dwords)
+        items = [(i, names2[i]) for i in candidates if names2[i] is not None]
+        for (i, _), (dchars, dwords) in zip(items, pairs_cache.distances(name1, items, compute_pair, PairsCache.params(dist=dist_threshold, norm=True))):
+            testsim1 = dchars <= dist_threshold
+            testsim2 = dwords <= dist_words_threshold
+            if (mode==0 and (testsim1 or testsim2)) or (mode==1 and testsim1 and testsim2):
+                found.append(i)
+        return found
+    for k, i in enumerate(candidates):
+        name2 = names2[i]
+        if name2 is None:
+            continue
+        # Compute similarity, with character-wise distance on the whole name and word-wise distance
+        if match_names_cascade(name1, name2, i, dist_threshold, dist_words_threshold, mode, stages=cascade, words_matcher=words_matcher, dist_chars=(dists_chars[k] if batch else None), stats=cascade_stats):
+            found.append(i)
+    return found
+
+class NameIndex(object):
+    """Persistent index of subject names, to be built once (eg, from a reference database) and reused across multiple merges, see merge_two_df(blocking=NameIndex) and compute_names_distance_matrix().
+    The names are cleaned up with normalize_name() and indexed in both a BK-tree on the levenshtein distance (for character-wise queries) and a q-grams inverted index of their words (for words-wise queries), which allows to find similar names without scanning the whole list.
+    Can be saved to disk with save() and loaded back with NameIndex.load()."""
+    def __init__(self, names=None, q=2):
+        self.q = q
+        self.names = []  # original names
+        self.names_clean = []  # distinct cleaned up names
+        self.originals = {}  # cleaned up name -> list of original names
+        self.blocking_index = None
+        self.bktree_children = []  # BK-tree as flat lists: children of each node, as a dict of distance -> node id (node ids are the ids in names_clean)
+        if names is not None:
+            self.build(names)
+
+    def __len__(self):
+        return len(self.names_clean)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.originals
+
+    def build(self, names):
+        """Build the index from a list of names (empty names are skipped)"""
+        self.names = [n for n in names if n]
+        self.names_clean = []
+        self.originals = OrderedDict()
+        for n in self.names:
+            cname = normalize_name(n)
+            if cname not in self.originals:
+                self.originals[cname] = []
+                self.names_clean.append(cname)
+            self.originals[cname].append(n)
+        self.blocking_index = build_names_blocking_index(self.names_clean, q=self.q)
+        # Build the BK-tree
+        self.bktree_children = [{} for _ in self.names_clean]
+        for i in range(1, len(self.names_clean)):
+            node = 0
+            while True:
+                d = distance.levenshtein(self.names_clean[i], self.names_clean[node])
+                child = self.bktree_children[node].get(d)
+                if child is None:
+                    self.bktree_children[node][d] = i
+                    break
+                node = child
+        return self
+
+    def query_ids(self, name, max_dist=0.2, clean=True):
+        """Find the ids (in names_clean) of all the indexed names at a normalized levenshtein distance (method=1) <= max_dist from the provided name, as a list of (distance, id) sorted by distance"""
+        if clean:
+            name = normalize_name(name)
+        if not self.names_clean:
+            return []
+        la = len(name)
+        # Maximum number of edits: dist <= max_dist * max(la, lb) with lb <= la + dist
+        if max_dist >= 1.0:
+            radius = float('inf')
+        else:
+            radius = int(max_dist * la / (1.0 - max_dist)) + 1
+        res = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            cname = self.names_clean[node]
+            d = distance.levenshtein(name, cname)
+            if d <= radius:
+                L = max(la, len(cname))
+                nd = d / float(L) if L else 0.0
+                if nd <= max_dist:
+                    res.append((nd, node))
+            for cd, child in self.bktree_children[node].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        return sorted(res)
+
+    def query(self, name, max_dist=0.2, clean=True):
+        """Find all the indexed names at a normalized levenshtein distance (method=1) <= max_dist from the provided name, as a list of (distance, original name) sorted by distance"""
+        return [(nd, n) for nd, node in self.query_ids(name, max_dist, clean=clean) for n in self.originals[self.names_clean[node]]]
+
+    def candidates_ids(self, name, dist_threshold=0.2, dist_words_threshold=0.4, mode=0, dist_words=None, clean=False):
+        """Find the ids (in names_clean) of the indexed names that may be similar to the provided (cleaned up) name, given the same tests as merge_two_df(), see blocking_candidates(). This is lossless: all names passing the tests are returned, but some returned names may not pass them."""
+        if clean:
+            name = normalize_name(name)
+        if dist_words is None:
+            dist_words = dist_threshold
+        cands_chars = set(node for _, node in self.query_ids(name, dist_threshold, clean=False))
+        # Words-wise test: a normalized jaccard distance below 1.0 requires at least one pair of words to match
+        if dist_words_threshold >= 1.0:
+            cands_words = set(range(len(self.names_clean)))
+        else:
+            index = self.blocking_index
+            cands_words = set()
+            for word in set(filter(None, re.split(index['wordsplit_pattern'], name))):
+                for wid in qgram_index_query(index['words'], word, dist_words):
+                    cands_words.update(index['words_names'][wid])
+        if mode == 1:
+            return cands_chars & cands_words
+        else:
+            return cands_chars | cands_words
+
+    def candidates(self, name, *args, **kwargs):
+        """Find the cleaned up indexed names that may be similar to the provided (cleaned up) name, see candidates_ids()"""
+        return set(self.names_clean[i] for i in self.candidates_ids(name, *args, **kwargs))
+
+    def mapped(self, names_clean):
+        """Map this index on a list of cleaned up names (None for empty names), to be used as a blocking index with blocking_candidates() and find_similar_names(), returning ids in this list. The names that are not indexed are always returned as candidates, so that the result stays exact."""
+        positions = {}
+        unindexed = []
+        for i, cname in enumerate(names_clean):
+            if cname is None:
+                continue
+            if cname in self.originals:
+                positions.setdefault(cname, []).append(i)
+            else:
+                unindexed.append(i)
+        return {'nameindex': self, 'positions': positions, 'unindexed': unindexed}
+
+    def save(self, path):
+        """Save the index to a file"""
+        with open(path, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """Load an index previously saved with save()"""
+        index = cls()
+        with open(path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+# Names of df2 and matching parameters of merge_two_df(), set once per worker process when n_jobs > 1
+_merge_worker_args = None
+
+def _merge_worker_init(names2, blocking_index, params):
+    """Initialize a merge_two_df() worker process with the data shared by all the tasks, so that they are sent only once per worker.
+    The worker opens its own connection to the pairs cache (params['pairs_cache'] is its (path, timeout)), since a SQLite connection cannot be used across fork(), and starts with its own empty statistics (else the statistics inherited from the parent process would be counted again)."""
+    global _merge_worker_args
+    params = dict(params)
+    if params.get('pairs_cache') is not None:
+        path, timeout = params['pairs_cache']
+        # The least recently used pairs are evicted by the parent process only, at the end of the merge
+        params['pairs_cache'] = PairsCache(path, maxsize=None, timeout=timeout, autoflush=None)
+    params['cascade_stats'] = {}
+    _merge_worker_args = (names2, blocking_index, params)
+
+def _merge_worker_chunk(task):
+    """Find the similar names for a chunk of names of df1 in a merge_two_df() worker process"""
+    chunkid, names1 = task
+    names2, blocking_index, params = _merge_worker_args
+    res = [find_similar_names(name1, names2, blocking_index, **params) for name1 in names1]
+    # Commit the new pairs of this chunk in the pairs cache, and send back the cache and cascade statistics of this chunk
+    pairs_cache = params.get('pairs_cache')
+    cache_stats = (0, 0)
+    if pairs_cache is not None:
+        pairs_cache.flush()
+        cache_stats = (pairs_cache.hits, pairs_cache.misses)
+        pairs_cache.hits = pairs_cache.misses = 0
+    cascade_stats = dict(params['cascade_stats'])
+    params['cascade_stats'].clear()
+    return chunkid, res, cache_stats, cascade_stats
+
+def _first_of_multivalue(x):
+    """Return the first value of a multi-valued cell (a list or a string representing a list), or else the value as-is"""
+    res = x if isinstance(x, list) else multivalue_eval(x)
+    return res[0] if isinstance(res, list) and res else x
+
+def merge_two_df(df1, df2, col='Name', dist_threshold=0.2, dist_words_threshold=0.4, mode=0, skip_sanity=False, keep_nulls=True, returnmerged=False, keep_lastname_only=False, prependcols=None, fillna=False, fillna_exclude=None, join_on_shared_keys=True, squish=True, blocking=False, batch=False, n_jobs=1, pairs_cache=None, cascade=MATCH_CASCADE_STAGES, cascade_stats=None, verbose=False, **kwargs):
     """Compute the remapping between two dataframes (or a single duplicated dataframe) based on one or multiple columns. Supports similarity matching (normalized character-wise AND words-wise levenshtein distance) for names, and date comparison using provided formatting.
     mode=0 is or test, 1 is and test. In other words, this is a join with fuzzy matching on one column (based on name/id) but supporting multiple columns with exact matching for the others.
     `keep_nulls=True` if you want to keep all records from both databases, False if you want only the ones that match both databases, 1 or 2 if you want specifically the ones that are in 1 or in 2
@@ -352,6 +1352,11 @@ def merge_two_df(df1, df2, col='Name', dist_threshold=0.2, dist_words_threshold=
     If `fillna_exclude` is specified with a list of columns, this list of columns won't be filled (particularly useful for dates).
     if `join_on_shared_keys=True`, if merging on multi-columns and not the same number of key columns are supplied, the merge will be done on only the shared keys in both dataframes: this is very convenient to allow to groupby in one dataframe according to some keys but not in the other one (eg, one is grouped by name and date so both are kept, while the other one is only grouped by name).
     if `squish=True`, the dataframes are each squished on key columns to make them unique, so that other non-key columns will get concatenated values. True by default, but if you have to non overlapping databases, then you can set this to False to keep all rows.
+    if `blocking=True` (or 'qgram'), the fuzzy matching will only compare the pairs of names that can possibly match, as found by a q-grams index of the names of df2 (see blocking_candidates()), instead of comparing every name of df1 against every name of df2. This gives exactly the same matches as the exhaustive comparison, but is much faster on big databases. `blocking` can also be a prebuilt NameIndex (eg, of a reference database reused across multiple merges), any name of df2 missing from the NameIndex will then be compared too.
+    if `batch=True`, the character-wise distances of each name of df1 against all its candidates in df2 are computed at once using the bit-parallel distance.nlevenshtein_many() (requires numpy), which gives the same results as distance.nlevenshtein() but much faster.
+    if `n_jobs` is above 1 (or -1 for all CPUs), the fuzzy matching of the names of df1 is split across a pool of processes. The result is exactly the same as with a single process.
+    if `pairs_cache` is provided, either as a path to a SQLite file or as a PairsCache object, the distances between names are cached on disk, so that re-running a merge only computes the pairs of names that were not compared before.
+    `cascade` is the list of stages of tests run on each pair of names, from the cheapest to the most expensive, stopping as soon as the outcome is decided (see match_names_cascade()). If `cascade_stats` is provided as a dict, it is filled with the number of pairs decided by each stage, which allows to tune the thresholds and stages for speed (also printed if `verbose=True`).
     """
     ### Preparing the input dataframes
     # If the key column is in fact a list of columns (so we will merge on multiple columns), we first extract and rename the id columns for ease
@@ -417,8 +1422,8 @@ def merge_two_df(df1, df2, col='Name', dist_threshold=0.2, dist_words_threshold=
     df2[col+'_orig2'] = df2[col]
     # if doing multiple consecutive merges, a name can in fact be a list of concatenated names, then extract the first name in the list
     # TODO: enhance this to account for all names when comparing
-    df1[col] = df1[col].apply(lambda x: df_literal_eval(x)[0] if isinstance(df_literal_eval(x), list) else x)
-    df2[col] = df2[col].apply(lambda x: df_literal_eval(x)[0] if isinstance(df_literal_eval(x), list) else x)
+    df1[col] = df1[col].apply(_first_of_multivalue)
+    df2[col] = df2[col].apply(_first_of_multivalue)
     # keep only the lastname (supposed to be first), this can ease comparison
     if keep_lastname_only:
         df1[col] = df1[col].apply(lambda x: x.split()[0])
@@ -429,33 +1434,87 @@ def merge_two_df(df1, df2, col='Name', dist_threshold=0.2, dist_words_threshold=
     list_names2 = df2[col].unique()
     ### Merge mapping construction based on id (name) column
     # Find all similar names in df2 compared to df1 (missing names will be None)
-    for c in _tqdm(list_names1, total=len(df1[col].unique()), desc='MERGE'):
-        found = False
-        #c = str(c)
-        if dist_threshold <= 0.0 and dist_words_threshold <= 0.0:
-            # No fuzzy matching, we simply compute equality
+    if dist_threshold <= 0.0 and dist_words_threshold <= 0.0:
+        # No fuzzy matching, we simply compute equality
+        for c in _tqdm(list_names1, total=len(list_names1), desc='MERGE'):
             if c in list_names2:
                 dmerge.append( (c, c) )
-                found = True
+            else:
+                dmerge.append( (c, None) )
+    else:
+        # Fuzzy matching
+        # Clean up the names only once (memoized), empty names of df2 are skipped
+        names1_clean = [normalize_name(c) for c in list_names1]
+        names2_clean = [normalize_name(cd) if cd else None for cd in list_names2]
+        ### Blocking: index the names of df2 to quickly find the candidates for each name of df1
+        blocking_index = None
+        if isinstance(blocking, NameIndex):
+            # Reuse a prebuilt index
+            blocking_index = blocking.mapped(names2_clean)
+        elif blocking:
+            if blocking is not True and blocking != 'qgram':
+                raise ValueError('Unknown blocking method: %s' % blocking)
+            blocking_index = build_names_blocking_index([name2 or '' for name2 in names2_clean])
+        # Split the names of df2 in words only once, and cache the words matches
+        words_matcher = WordsJaccardMatcher(names2_clean, partial=False, norm=True, dist=dist_threshold)
+        # Open the on-disk cache of names pairs distances
+        close_cache = False
+        if pairs_cache is not None and not isinstance(pairs_cache, PairsCache):
+            pairs_cache = PairsCache(pairs_cache)
+            close_cache = True
+        if cascade_stats is None:
+            cascade_stats = {}
+        params = {'dist_threshold': dist_threshold, 'dist_words_threshold': dist_words_threshold, 'mode': mode, 'batch': batch, 'words_matcher': words_matcher, 'pairs_cache': pairs_cache, 'cascade': tuple(cascade), 'cascade_stats': cascade_stats}
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs > 1 and len(names1_clean) > 1:
+            # Multi-processing: split the names of df1 in chunks, the names of df2 are sent only once to each worker
+            chunksize = max(1, len(names1_clean) // (n_jobs * 10))
+            chunks = [(chunkid, names1_clean[i:i+chunksize]) for chunkid, i in enumerate(range(0, len(names1_clean), chunksize))]
+            matches_chunks = [None] * len(chunks)
+            # Each worker opens its own connection to the pairs cache
+            worker_params = dict(params)
+            if pairs_cache is not None:
+                pairs_cache.flush()
+                worker_params['pairs_cache'] = (pairs_cache.path, pairs_cache.timeout)
+            pool = multiprocessing.Pool(n_jobs, initializer=_merge_worker_init, initargs=(names2_clean, blocking_index, worker_params))
+            try:
+                pbar = _tqdm(total=len(names1_clean), desc='MERGE')
+                for chunkid, res, cache_stats, chunk_cascade_stats in pool.imap_unordered(_merge_worker_chunk, chunks):
+                    # Store the results of this chunk at its position, so that the final order is the same as with a single process
+                    matches_chunks[chunkid] = res
+                    pbar.update(len(res))
+                    if pairs_cache is not None:
+                        pairs_cache.hits += cache_stats[0]
+                        pairs_cache.misses += cache_stats[1]
+                    for stage, count in chunk_cascade_stats.items():
+                        cascade_stats[stage] = cascade_stats.get(stage, 0) + count
+                pbar.close()
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            matches = [m for res in matches_chunks for m in res]
         else:
-            # Fuzzy matching
-            for cd in list_names2:
-                if not cd:
-                    continue
-                #cd = str(cd)
-                # Clean up the names
-                name1 = cleanup_name(replace_buggy_accents(c))
-                name2 = cleanup_name(replace_buggy_accents(cd))
-                # Compute similarity
-                testsim1 = distance.nlevenshtein(name1, name2, method=1) <= dist_threshold  # character-wise distance on the whole name
-                testsim2 = distance_jaccard_words_split(name1, name2, partial=False, norm=True, dist=dist_threshold) <= dist_words_threshold  # word-wise distance
-                if (mode==0 and (testsim1 or testsim2)) or (mode==1 and testsim1 and testsim2): # use shortest distance with normalized levenshtein
-                    # Found a similar name in both df, add the names
-                    dmerge.append( (c, cd) )
-                    found = True
-        # Did not find any similar name, add as None
-        if not found:
-            dmerge.append( (c, None) )
+            matches = (find_similar_names(name1, names2_clean, blocking_index, **params) for name1 in names1_clean)
+        for c, found in _tqdm(izip(list_names1, matches), total=len(list_names1), desc='MERGE', disable=(n_jobs > 1)):
+            if found:
+                # Found similar names in both df, add the names
+                dmerge.extend( (c, list_names2[i]) for i in found )
+            else:
+                # Did not find any similar name, add as None
+                dmerge.append( (c, None) )
+        if verbose and cascade_stats:
+            print('Matching cascade statistics (pairs decided per stage): %s' % ', '.join('%s=%i' % (stage, cascade_stats[stage]) for stage in MATCH_CASCADE_STAGES if stage in cascade_stats))
+        if pairs_cache is not None:
+            if verbose:
+                print('Pairs cache statistics: %s' % pairs_cache.stats())
+            if close_cache:
+                pairs_cache.close()
+            else:
+                pairs_cache.flush()
     # Find all names missing in df1 compared to df2
     missing = [(None, x) for x in list(set(list_names2) - set([y for _,y in dmerge if y is not None]))]
     dmerge.extend(missing)
@@ -722,9 +1781,9 @@ def cleanup_name_df(df, col='name'):
     """Cleanup the name field of a dataframe"""
     df2 = df.copy()
     try:
-        df2[col] = df2[col].astype('str').apply(lambda name: cleanup_name(name))
+        df2[col] = cleanup_names(df2[col].astype('str'))
     except UnicodeEncodeError as exc:
-        df2[col] = df2[col].astype('unicode').apply(lambda name: cleanup_name(name))
+        df2[col] = cleanup_names(df2[col].astype('unicode'))
     return df2
     #for c in df2.itertuples():  # DEPRECATED: itertuples() is limited to 255 columns in Python < 3.7, prefer to avoid this approach
     #    try:
@@ -766,52 +1825,230 @@ def cleanup_name_customregex_df(cf, customregex=None):
     cf['name'] = cf['name'].apply(lambda name: cleanup_name_customregex(name, customregex))
     return cf
 
-def compute_names_distance_matrix(list1, list2, dist_threshold_letters=0.2, dist_threshold_words=0.2, dist_threshold_words_norm=True, dist_minlength=0):
+def compute_names_distance_matrix(list1, list2, dist_threshold_letters=0.2, dist_threshold_words=0.2, dist_threshold_words_norm=True, dist_minlength=0, pairs_cache=None, output='dict', top_k=None):
     """Find all similar items in two lists that are below a specified distance threshold (using both letters- and words- levenshtein distances). This is different from disambiguate_names() which is working on a single dataframe (trying to uniformize the names (mis)spellings).
+    list2 can also be a prebuilt NameIndex, then only the names that can possibly match are compared.
+    pairs_cache can be a path to a SQLite file or a PairsCache object, to reuse the distances computed in previous runs.
+    output='dict' returns a dict of each (cleaned up) name of list1 -> list of similar (cleaned up) names of list2, or None if none was found.
+    output='coo' returns the scored matches as a sparse matrix in coordinates format, ie, a tuple of 4 numpy arrays (rows, cols, dist_letters, dist_words), where rows are the indices in list1 and cols the indices in list2 (or in list2.names_clean for a NameIndex), so that stricter thresholds can be chosen afterwards without recomputing the distances. Memory is proportional to the number of matches.
+    If top_k is set, only the top_k closest matches of each name of list1 are kept (by letters distance then words distance).
     Note: this works less efficiently than merge_two_df(), you should use the latter."""
-    dist_matches = {}
-    for subj in _tqdm(list1, total=len(list1), desc='MERGE'):
-        found = False
-        subj = cleanup_name(replace_buggy_accents(subj))
-        for c in list2:
-            c = cleanup_name(replace_buggy_accents(c))
+    if output not in ('dict', 'coo'):
+        raise ValueError('output must be either dict or coo, got: %s' % output)
+    if isinstance(list2, NameIndex):
+        name_index = list2
+        # The words-wise test can only be used to prune candidates if it requires at least one matching word
+        if (dist_threshold_words_norm is True and dist_threshold_words < 1.0) or (dist_threshold_words_norm is None and dist_threshold_words > 0):
+            words_threshold = 0.0
+        else:
+            words_threshold = 1.0
+        names2 = name_index.names_clean
+    else:
+        name_index = None
+        names2 = [normalize_name(c) for c in list2]
+    # Split the names of list2 in words only once, and cache the words matches
+    words_matcher = WordsJaccardMatcher(names2, partial=False, norm=dist_threshold_words_norm, dist=dist_threshold_letters, minlength=dist_minlength)
+    # Open the on-disk cache of names pairs distances
+    close_cache = False
+    if pairs_cache is not None:
+        if not isinstance(pairs_cache, PairsCache):
+            pairs_cache = PairsCache(pairs_cache)
+            close_cache = True
+        cache_params = PairsCache.params(dist=dist_threshold_letters, norm=dist_threshold_words_norm, minlength=dist_minlength)
+    scored = output == 'coo' or top_k is not None
+    # Without normalization, the words distance is the number of matching words, the higher the closer
+    words_sign = -1 if dist_threshold_words_norm is None else 1
+
+    def find_matches(subj):
+        """Return the list of (id in names2, letters distance, words distance) of the names similar to subj (the distances are only computed if scored)"""
+        if name_index is not None:
+            candidates = sorted(name_index.candidates_ids(subj, dist_threshold_letters, words_threshold))
+        else:
+            candidates = range(len(names2))
+        if pairs_cache is not None:
+            # Get the distances of the pairs already seen from the cache, and compute the full distances of the new pairs only
+            items = [(j, names2[j]) for j in candidates]
+            cached_dists = pairs_cache.distances(subj, items, lambda j, c: (distance.nlevenshtein(subj, c, method=1), words_matcher.distance(subj, j)), cache_params)
+        matches = []
+        for k, j in enumerate(candidates):
+            c = names2[j]
+            if pairs_cache is not None:
+                dchars, dwords = cached_dists[k]
+                testsim1 = dchars <= dist_threshold_letters
+            else:
+                dchars = dwords = None
+                testsim1 = distance.nlevenshtein_within(subj, c, dist_threshold_letters)
+            if dwords is None and (not testsim1 or scored):
+                dwords = words_matcher.distance(subj, j)
             # use shortest distance with either normalized levenshtein distance or non-normalized levenshtein distance
-            if distance.nlevenshtein(subj, c, method=1) <= dist_threshold_letters or (
-                (dist_threshold_words_norm is not None and distance_jaccard_words_split(subj, c, partial=False, norm=dist_threshold_words_norm, dist=dist_threshold_letters, minlength=dist_minlength) <= dist_threshold_words) or
-                (dist_threshold_words_norm is None and distance_jaccard_words_split(subj, c, partial=False, norm=dist_threshold_words_norm, dist=dist_threshold_letters, minlength=dist_minlength) >= dist_threshold_words)
+            if testsim1 or (
+                (dist_threshold_words_norm is not None and dwords <= dist_threshold_words) or
+                (dist_threshold_words_norm is None and dwords >= dist_threshold_words)
                 ):
-                if subj not in dist_matches:
-                    dist_matches[subj] = []
-                dist_matches[subj].append(c)
-                found = True
-        if not found:
-            dist_matches[subj] = None
+                if scored and dchars is None:
+                    dchars = distance.nlevenshtein(subj, c, method=1)
+                matches.append((j, dchars, dwords))
+        if top_k is not None:
+            matches = sorted(matches, key=lambda m: (m[1], words_sign * m[2], m[0]))[:top_k]
+        return matches
+
+    # Compare each distinct name of list1 only once
+    subjs = [normalize_name(subj) for subj in list1]
+    matches_by_subj = {}
+    for subj in _tqdm(subjs, total=len(subjs), desc='MERGE'):
+        if subj not in matches_by_subj:
+            matches_by_subj[subj] = find_matches(subj)
+    if pairs_cache is not None:
+        if close_cache:
+            pairs_cache.close()
+        else:
+            pairs_cache.flush()
+    if output == 'coo':
+        # Build the sparse matrix of the matches in coordinates format
+        rows, cols, dists_letters, dists_words = [], [], [], []
+        for i, subj in enumerate(subjs):
+            for j, dchars, dwords in matches_by_subj[subj]:
+                rows.append(i)
+                cols.append(j)
+                dists_letters.append(dchars)
+                dists_words.append(dwords)
+        return (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(dists_letters, dtype=np.float64), np.array(dists_words, dtype=np.float64))
     # Remove duplicate values (ie, csv names)
-    dist_matches = {k: (list(set(v)) if v else v) for k, v in dist_matches.items()}
+    dist_matches = {k: (list(set(names2[m[0]] for m in v)) if v else None) for k, v in matches_by_subj.items()}
     return dist_matches
 
-def disambiguate_names(df, dist_threshold=0.2, col='name', verbose=False): # TODO: replace by the updated compute_names_distance_matrix() function?
-    """Disambiguate names in a single dataframe, in other words finds all the different (mis)spellings of the same person's name and uniformize them all, so that we can easily find all the records pertaining to a single subject. In other words, this is like a join with fuzzy matching on a single column and dataframe. This is different from compute_names_distance_matrix() function which works on two different dataframes."""
+class DisjointSet(object):
+    """Union-find (disjoint-set) structure over the integers 0 to n-1, with path compression and union by rank"""
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.rank = [0] * n
+
+    def find(self, x):
+        """Return the representative of the set containing x"""
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        """Merge the sets containing x and y"""
+        rx, ry = self.find(x), self.find(y)
+        if rx == ry:
+            return
+        if self.rank[rx] < self.rank[ry]:
+            rx, ry = ry, rx
+        self.parent[ry] = rx
+        if self.rank[rx] == self.rank[ry]:
+            self.rank[rx] += 1
+
+    def groups(self):
+        """Return the list of all sets, each as an ordered list of its members"""
+        groups = OrderedDict()
+        for x in range(len(self.parent)):
+            groups.setdefault(self.find(x), []).append(x)
+        return list(groups.values())
+
+def disambiguate_names(df, dist_threshold=0.2, col='name', blocking=True, verbose=False):
+    """Disambiguate names in a single dataframe, in other words finds all the different (mis)spellings of the same person's name and uniformize them all, so that we can easily find all the records pertaining to a single subject. In other words, this is like a join with fuzzy matching on a single column and dataframe. This is different from compute_names_distance_matrix() function which works on two different dataframes.
+    The unique names are compared using the same tests as merge_two_df() (with dist_threshold for both the character-wise and words-wise distances), then similar names are clustered (transitively) and each cluster is renamed to its first spelling in the dataframe. As before, the rows that originally had this first spelling get the other spellings of the cluster in the column name_alt (separated by '/'), the other rows keeping an empty name_alt.
+    If blocking=True, only the pairs of names that can possibly match are compared (see build_names_blocking_index()), which gives the same result but faster."""
     df2 = df.copy()
     df2 = df2.assign(**{col+'_alt': ''})  # create new column name_alt with empty values by default
-    for cindex, c in _tqdm(df2.iterrows(), total=len(df2)): # Updated to use iterrows() to support more than 255 columns (because itertuples() is limited by Python 2 limit of 255 max items in a tuple, this might have changed in Python 3!)
-        for c2index, c2 in df2.ix[cindex+1:,:].iterrows():
-            if c[col] != c2[col] and \
-            (distance.nlevenshtein(c[col], c2[col], method=1) <= dist_threshold or distance_jaccard_words_split(c2[col], c[col], partial=False, norm=True, dist=dist_threshold) <= dist_threshold): # use shortest distance with normalized levenshtein
-                if verbose:
-                    print(c[col], c2[col], c2index, distance.nlevenshtein(c[col], c2[col], method=1))
-                # Replace the name of the second entry with the name of the first entry
-                df2.loc[c2index, col] = c[col]
-                # Add the other name as an alternative name, just in case we did a mistake for example
-                df2.loc[cindex, col+'_alt'] = df2.loc[cindex, col+'_alt'] + '/' + c2[col] if df2.loc[cindex, col+'_alt'] else c2[col]
+    # Work on the unique names, in their order of appearance
+    names = list(df2[col].dropna().unique())
+    blocking_index = build_names_blocking_index(names) if blocking else None
+    words_matcher = WordsJaccardMatcher(names, partial=False, norm=True, dist=dist_threshold)
+    # Cluster all similar names, comparing each pair only once: each name against the earlier names only (the later names are None, so that they are skipped without computing any distance)
+    clusters = DisjointSet(len(names))
+    earlier = [None] * len(names)
+    for i, name in _tqdm(enumerate(names), total=len(names), desc='DISAMBIG'):
+        for j in find_similar_names(name, earlier, blocking_index, dist_threshold=dist_threshold, dist_words_threshold=dist_threshold, mode=0, words_matcher=words_matcher):
+            if verbose:
+                print(names[j], name, distance.nlevenshtein(names[j], name, method=1))
+            clusters.union(i, j)
+        earlier[i] = name
+    # Pick the first spelling of each cluster as the canonical name, which gets the other spellings as alternatives
+    canonical = {}
+    alternatives = {}
+    for members in clusters.groups():
+        if len(members) > 1:
+            alternatives[names[members[0]]] = '/'.join(names[m] for m in members[1:])
+            for m in members:
+                canonical[names[m]] = names[members[0]]
+    # Write back all the names at once
+    if canonical:
+        df2[col+'_alt'] = df2[col].map(alternatives).fillna('')
+        remapped = df2[col].map(canonical)
+        df2[col] = remapped.where(remapped.notnull(), df2[col])
     return df2
 
+def df_concat_vals(df, col):
+    """Fast equivalent of df.groupby(col, sort=False).agg(concat_vals): squash the rows of each group of the key column(s) col into one row, where each other column gets a singleton if all values of the group are equal, or else the list of values (or None if all are null/empty).
+    The groups are computed only once and the rows stably sorted by group, then for each column the groups with a single distinct value are found at once from the factorized values, so that concat_vals() is only called for the groups that have multiple values (or null values or unhashable values, eg, lists)."""
+    if len(df) == 0:
+        return df.groupby(col, sort=False).agg(concat_vals)
+    keys = [col] if isinstance(col, basestring) else list(col)
+    # Group id of each row, in the order of first appearance (same as groupby with sort=False)
+    gid = df.groupby(keys, sort=False).ngroup().values
+    order = np.argsort(gid, kind='mergesort')  # stable sort, to keep the order of the rows in each group
+    sgid = gid[order]
+    starts = np.flatnonzero(np.concatenate(([True], sgid[1:] != sgid[:-1])))
+    ends = np.concatenate((starts[1:], [len(sgid)]))
+    sizes = ends - starts
+    # Index of the squashed dataframe (the key values of the first row of each group)
+    firsts = order[starts]
+    if isinstance(col, basestring):
+        index = pd.Index(df[col].values[firsts], name=col)
+    else:
+        index = pd.MultiIndex.from_arrays([df[k].values[firsts] for k in keys], names=keys)
+    # Squash each column
+    squashed = OrderedDict()
+    for c in df.columns:
+        if c in keys:
+            continue
+        serie = df[c]
+        if not isinstance(serie.dtype, np.dtype) or serie.dtype.kind in 'mM':
+            # Dates, timedeltas and pandas extension dtypes (eg, dates with a timezone, categories) as objects, so that values are kept as Timestamp/NaT instead of raw integers
+            serie = serie.astype(object)
+        vals = serie.values[order]
+        res = np.empty(len(starts), dtype='object')
+        try:
+            codes = pd.factorize(vals)[0]  # null values get -1
+        except TypeError:
+            # Unhashable values, all groups will use concat_vals()
+            todo = range(len(starts))
+        else:
+            cmin = np.minimum.reduceat(codes, starts)
+            cmax = np.maximum.reduceat(codes, starts)
+            # Groups with a single distinct value get a singleton (null values are never considered equal by concat_vals, except if there is only one)
+            single = (cmin == cmax) & ((cmin >= 0) | (sizes == 1))
+            res[single] = vals[starts[single]]
+            # Groups with multiple distinct non-null values get the list of all their values, or None if none is valid (ie, only empty strings or lists)
+            multi = np.flatnonzero(~single & (cmin >= 0))
+            if len(multi):
+                if vals.dtype.name == 'object':
+                    valid = np.array([(hasattr(y, '__len__') and len(y) > 0) or isinstance(y, numbers.Number) for y in vals], dtype=np.int8)
+                    anyvalid = np.maximum.reduceat(valid, starts)
+                else:
+                    anyvalid = np.ones(len(starts), dtype=np.int8)
+                for g in multi:
+                    res[g] = vals[starts[g]:ends[g]].tolist() if anyvalid[g] else None
+            # Groups with null values are left to concat_vals()
+            todo = np.flatnonzero(~single & (cmin < 0))
+        for g in todo:
+            res[g] = concat_vals(vals[starts[g]:ends[g]].tolist())
+        squashed[c] = pd.Series(res.tolist(), index=index)
+    return pd.DataFrame(squashed, index=index, columns=[c for c in df.columns if c not in keys])
+
 def df_concatenate_all_but(df, col, setindex=False):
     """Make sure each id (in col) is unique, else concatenate all other rows for each id into one row.
     col can either be a string for a single column name, or a list of column names to use for the aggregation."""
     df2 = df.copy()
     df2.loc[:,col] = df2.loc[:,col].fillna(value='')  # fill nan values with placeholder to avoid losing these rows, particularly with multiple columns as keys of groupby, this can lead to mysterious loss of rows. Indeed, pandas drops any row where the groupby key columns have a nan or nat value (in any of the key columns! Even if other key columns are filled!). There is currently no option to disable this behavior. See https://github.com/pandas-dev/pandas/issues/3729 and https://stackoverflow.com/questions/18429491/groupby-columns-with-nan-missing-values for more info.
-    df2 = df2.reset_index().groupby(col, sort=False).agg(concat_vals)  # groupby the key columns and aggregate by concatenating duplicated values (using our custom function concat_vals)
+    df2 = df_concat_vals(df2.reset_index(), col)  # groupby the key columns and aggregate by concatenating duplicated values (with the same results as using our custom function concat_vals, but much faster)
     df2.reset_index(inplace=True)
     if setindex:
         df2.set_index(col, inplace=True)
@@ -855,6 +2092,43 @@ def string_to_unicode(s, failsafe_encoding='iso-8859-1', skip_errors=False):
                 raise
     return s
 
+def _df_set_column(df, pos, values):
+    """Replace the column at position pos of a dataframe (inplace) by the given values, as an object column (without any dtype inference, which could for example convert empty strings to NaT in a column of dates), also with duplicated columns names (assigning with df.iloc or by name writes into all the columns of the same name in some pandas versions)"""
+    columns = df.columns
+    df.columns = range(len(columns))
+    df[pos] = pd.Series(values, index=df.index, dtype='object')
+    df.columns = columns
+
+def _df_map_strings(df, cols, func, types, progress_bar=False, desc='UNICODE', print_errors=False):
+    """Apply func to all the values of the given types in the columns cols of a dataframe (inplace), column by column: non-object columns are skipped, and func is called only once per distinct value, then the results are mapped back on all the cells.
+    If print_errors=True and func fails with a UnicodeDecodeError, the column and index of the first cell having the failing value are printed before raising."""
+    # Process each column once by position, to also support duplicated columns names
+    cols = set(cols)
+    positions = [i for i, c in enumerate(df.columns) if c in cols]
+    if progress_bar:
+        pbar = _tqdm(total=len(positions) * len(df), desc=desc)
+    for pos in positions:
+        serie = df.iloc[:, pos]
+        if serie.dtype.name == 'object':
+            # Compute func once for each distinct value (keyed by type too, because in Python 2 an ascii str and its unicode counterpart are equal)
+            mapping = {}
+            for k, x in enumerate(serie.values):
+                if isinstance(x, types) and (type(x), x) not in mapping:
+                    try:
+                        mapping[(type(x), x)] = func(x)
+                    except UnicodeDecodeError as exc:
+                        if print_errors:
+                            print('Error at column "%s" index %s' % (df.columns[pos], str(serie.index[k])))
+                        raise
+            if mapping:
+                # Map back the converted values on all cells (using the raw values to avoid any index alignment)
+                _df_set_column(df, pos, [mapping[(type(x), x)] if isinstance(x, types) else x for x in serie.values])
+        if progress_bar:
+            pbar.update(len(df))
+    if progress_bar:
+        pbar.close()
+    return df
+
 def df_to_unicode(df_in, cols=None, failsafe_encoding='iso-8859-1', skip_errors=False, progress_bar=False):
     """Ensure unicode encoding for all strings in the specified columns of a dataframe.
     If cols=None, will walk through all columns.
@@ -878,33 +2152,112 @@ def df_to_unicode(df_in, cols=None, failsafe_encoding='iso-8859-1', skip_errors=
         df.columns = [unicode(cleanup_name(x, normalize=False, clean_nonletters=False), errors='ignore') for x in df.columns]
         # By default, take all columns
         cols = df.columns
-    # Calculate total number of items
-    if progress_bar:
-        pbar_total = 0
-        for col in cols:
-            pbar_total += len(df[col].index)
-    # Main loop
-    if progress_bar:
-        pbar = _tqdm(total=pbar_total, desc='UNICODE', disable=(not progress_bar))
-    for col in cols:
-        for idx in df[col].index:
-            # Unidecode if value is a string
-            if isinstance(df.loc[idx,col], str):  # if item is already unicode, we don't need to do anything (also if item is null or another type, we do not need to decode)
-                df.loc[idx,col] = string_to_unicode(df.loc[idx,col], failsafe_encoding=failsafe_encoding, skip_errors=skip_errors)
-            if progress_bar:
-                pbar.update()
+    # Convert all the str values, column by column
+    _df_map_strings(df, cols, lambda x: string_to_unicode(x, failsafe_encoding=failsafe_encoding, skip_errors=skip_errors), str, progress_bar=progress_bar, desc='UNICODE')
     # Restore index
     if idxbak:
         df.set_index(idxbak, inplace=True)
     return df
 
-def df_to_unicode_fast(df_in, cols=None, replace_ascii=False, skip_errors=False, progress_bar=False):
+# Cache of the encodings detected by df_to_unicode_fast(), per (source file, column)
+_encodings_cache = LRUCache(maxsize=10000)
+
+def detect_encoding(values, min_confidence=0.9, max_samples=10000, with_confidence=False):
+    """Detect the encoding of a sequence of (str) strings, by incrementally feeding chardet's UniversalDetector with only the distinct non-ascii strings, and stopping as soon as the confidence of the detection reaches min_confidence (or after max_samples strings).
+    Returns 'ascii' if all strings are ascii, or None if there is no str to decode (eg, only unicode strings or other types). If with_confidence is True, returns a tuple (encoding, confidence)."""
+    detector = UniversalDetector()
+    seen = set()
+    found_str = False
+    fed = []
+    checkpoint = 16
+    for x in values:
+        if not isinstance(x, str) or x in seen:
+            continue
+        found_str = True
+        seen.add(x)
+        try:
+            x.decode('ascii')
+            continue
+        except UnicodeDecodeError:
+            pass
+        detector.feed(x + '\n')
+        fed.append(x)
+        if detector.done or len(fed) >= max_samples:
+            break
+        if len(fed) >= checkpoint:
+            # Check the confidence of the detection on the strings fed so far (the detector cannot be queried without closing it), at exponentially spaced checkpoints to limit the overhead
+            checkpoint *= 2
+            peek = chardet.detect('\n'.join(fed))
+            if peek['encoding'] and peek['confidence'] >= min_confidence:
+                return (peek['encoding'], peek['confidence']) if with_confidence else peek['encoding']
+    if not found_str:
+        return (None, 0.0) if with_confidence else None
+    if not fed:
+        return ('ascii', 1.0) if with_confidence else 'ascii'
+    detector.close()
+    return (detector.result['encoding'], detector.result['confidence']) if with_confidence else detector.result['encoding']
+
+def _encodings_cache_key(source, col):
+    """Key of a column of a source file in the encodings cache, including the file modification time and size so that a modified file is detected again"""
+    if isinstance(source, basestring) and os.path.isfile(source):
+        return (os.path.abspath(source), os.path.getmtime(source), os.path.getsize(source), col)
+    return (source, col)
+
+def _encodings_sidecar_path(source):
+    """Path of the sidecar storing the encodings detected for the columns of a source file (see df_to_unicode_fast())"""
+    return source + '.encodings'
+
+def _encodings_sidecar_load(source):
+    """Load into the encodings cache the encodings stored in the sidecar of a source file, if it is still up to date (the file has the same modification time and size)"""
+    sidecar_path = _encodings_sidecar_path(source)
+    if not os.path.isfile(sidecar_path):
+        return
+    try:
+        with open(sidecar_path, 'rb') as f:
+            sidecar = pickle.load(f)
+    except Exception as exc:
+        # Truncated or incompatible sidecar, it will be rewritten
+        return
+    if sidecar.get('mtime') != os.path.getmtime(source) or sidecar.get('size') != os.path.getsize(source):
+        return
+    for col, encoding in sidecar['encodings'].items():
+        _encodings_cache.set(_encodings_cache_key(source, col), encoding)
+
+def _encodings_sidecar_save(source):
+    """Store the encodings cached for the columns of a source file in its sidecar, with the modification time and size of the file. Errors (eg, a read-only folder) are ignored, the sidecar is only an optimization."""
+    key = _encodings_cache_key(source, None)[:-1]
+    encodings = dict((k[-1], encoding) for k, encoding in _encodings_cache._data.items() if k[:-1] == key)
+    try:
+        with open(_encodings_sidecar_path(source), 'wb') as f:
+            pickle.dump({'mtime': key[1], 'size': key[2], 'encodings': encodings}, f, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError, pickle.PicklingError) as exc:
+        pass
+
+def encodings_cache_save(path):
+    """Save the cache of detected encodings (see df_to_unicode_fast()) to a file, so that it can be reused by other processes with encodings_cache_load()"""
+    with open(path, 'wb') as f:
+        pickle.dump(list(_encodings_cache._data.items()), f, pickle.HIGHEST_PROTOCOL)
+
+def encodings_cache_load(path):
+    """Load a cache of detected encodings saved with encodings_cache_save(), if the file exists"""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for key, encoding in pickle.load(f):
+                _encodings_cache.set(key, encoding)
+
+def df_to_unicode_fast(df_in, cols=None, replace_ascii=False, skip_errors=False, progress_bar=False, source=None, min_confidence=0.9, persist=True):
     """Ensure unicode encoding for all strings in the specified columns of a dataframe in a fast way, and optionally by replacing non recognized characters by ascii equivalents. Also ensures that columns names are correctly decodable as unicode if cols=None.
     If cols=None, will walk through all columns.
     If replace_ascii, will replace special characters with the closest ASCII counterpart (using unidecode) if the conversion to unicode fails
     If skip_errors=True, the unicode encoding will be forced by skipping undecodable characters (errors='ignore').
     The main difference with df_to_unicode() is that the former tries to maintain special characters (instead of replacing them with their closest ascii counterpart) and it is slower (but more thorough, it should not miss any field, whereas the fast version will work column by column and thus might miss a column of mixed types).
+    The encoding of each column is detected with detect_encoding(), stopping as soon as the detection reaches min_confidence. If source is provided (usually the path of the csv file the dataframe was loaded from), the detected encodings are cached per (source, column), so that loading the same file again does not detect them again (the cache can be shared across processes with encodings_cache_save() and encodings_cache_load()).
+    If source is a file and persist is True, the encodings are also stored in a sidecar next to it (source + '.encodings'), keyed on the file modification time and size, and are reused from there by the next sessions and processes.
     """
+    persist = persist and isinstance(source, basestring) and os.path.isfile(source)
+    if persist:
+        _encodings_sidecar_load(source)
+    detected = False
     # Make a copy to avoid tampering the original
     df = df_in.copy()
     # If there is a complex index, it might contain strings, so we reset it as columns so that we can unidecode indices too, and we will restore the indices at the end
@@ -930,14 +2283,16 @@ def df_to_unicode_fast(df_in, cols=None, replace_ascii=False, skip_errors=False,
         if (len(df.loc[:, col].shape) > 1 and df.loc[:, col].shape[1] > 1) or df.loc[:, col].dtype.name != 'object':
             continue
         try:
-            # First try a decoding by detecting the correct encoding
-            #encoding = chardet.detect(''.join(df.loc[:, col]))['encoding']
-            allvals = (x if isinstance(x, basestring) else str(x) for _, x in df.loc[:, col].items())
-            allvalsjoined = ''.join(allvals)
-            if isinstance(allvalsjoined, unicode):  # if unicode, skip decoding
-                encoding = None
-            else:
-                encoding = chardet.detect(allvalsjoined)['encoding']
+            # First try a decoding by detecting the correct encoding (or reuse the encoding detected previously for the same source and column)
+            encoding = _nocache
+            if source is not None:
+                cache_key = _encodings_cache_key(source, col)
+                encoding = _encodings_cache.get(cache_key, _nocache)
+            if encoding is _nocache:
+                encoding = detect_encoding(df.loc[:, col].values, min_confidence=min_confidence)
+                if source is not None:
+                    _encodings_cache.set(cache_key, encoding)
+                    detected = True
             if encoding:
                 df.loc[:, col] = df.loc[:, col].apply(lambda x: x.decode(encoding, errors=serrors) if isinstance(x, str) else x)
             #df.loc[:, col] = df.loc[:, col].astype('unicode')  # DEPRECATED: works but if we do this, all null values (nan, nat, etc) will be converted to strings and become very difficult to process (eg, not detectable using pd.isnull())!
@@ -957,6 +2312,9 @@ def df_to_unicode_fast(df_in, cols=None, replace_ascii=False, skip_errors=False,
                 else:
                     print('Failed with column: %s' % col)
                     raise
+    # Store the new encodings in the sidecar of the source
+    if persist and detected:
+        _encodings_sidecar_save(source)
     # Restore index
     if idxbak:
         df.set_index(idxbak, inplace=True)
@@ -979,35 +2337,23 @@ def df_encode(df_in, cols=None, encoding='utf-8', skip_errors=False, decode_if_e
         df.columns = [x.encode(encoding) for x in df.columns]
         # Use all columns, and the new column names encoded
         cols = df.columns
-    # Calculate total number of items
-    if progress_bar:
-        pbar_total = 0
-        for col in cols:
-            pbar_total += len(df[col].index)
-    # Main loop
-    if progress_bar:
-        pbar = _tqdm(total=pbar_total, desc='UNICODE', disable=(not progress_bar))
-    for col in cols:
-        for idx in df[col].index:
-            # Unidecode if value is a string
-            if isinstance(df.loc[idx,col], (basestring, unicode)):
-                try:
-                    # Try to encode to utf-8, but only if it is unicode
-                    if isinstance(df.loc[idx,col], unicode):
-                        df.loc[idx,col] = df.loc[idx,col].encode(encoding)
-                    elif decode_if_errors:
-                        df.loc[idx,col] = string_to_unicode(df.loc[idx,col]).encode(encoding)
-                    else:
-                        raise ValueError('Error at column "%s" index %s: not unicode!')
-                except UnicodeDecodeError as exc:
-                    # At worst, try unidecode
-                    if skip_errors:
-                        df.loc[idx,col] = _unidecode(df.loc[idx,col]).encode(encoding)
-                    else:
-                        print('Error at column "%s" index %s' % (col, str(idx)))
-                        raise
-            if progress_bar:
-                pbar.update()
+    def encode_value(x):
+        """Encode one string"""
+        try:
+            # Try to encode to utf-8, but only if it is unicode
+            if isinstance(x, unicode):
+                return x.encode(encoding)
+            elif decode_if_errors:
+                return string_to_unicode(x).encode(encoding)
+            else:
+                raise ValueError('Error: not unicode: %s' % x)
+        except UnicodeDecodeError as exc:
+            # At worst, try unidecode
+            if skip_errors:
+                return _unidecode(x).encode(encoding)
+            raise
+    # Encode all the strings, column by column
+    _df_map_strings(df, cols, encode_value, (basestring, unicode), progress_bar=progress_bar, desc='UNICODE', print_errors=True)
     # Restore index
     if idxbak:
         df.set_index(idxbak, inplace=True)
@@ -1020,6 +2366,11 @@ def df_literal_eval(xin, aggressive=False):
         x = str(xin).replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace("'", '')
     else:
         x = xin
+    if not aggressive:
+        # Lists in the multi-value format (see serialize_multivalue())
+        res = parse_multivalue(x)
+        if isinstance(res, list):
+            return res
     try:
         # Try to evaluate using ast
         return(ast.literal_eval(x))
@@ -1034,6 +2385,341 @@ def df_literal_eval(xin, aggressive=False):
             # Else simply return the item as-is
             return xin
 
+# Prefix of the multi-valued cells serialized by serialize_multivalue(), followed by a JSON list
+MULTIVALUE_PREFIX = '@mv'
+# Strings that could be mistaken for a serialized multi-valued cell (or for an escaped one), and are thus escaped by prepending a backslash
+_MULTIVALUE_ESCAPE_REGEX = re.compile(r'^\\*@mv\[')
+
+def _multivalue_item(x):
+    """Decode the str items of a multi-valued cell (byte strings in Python 2) to unicode before serializing them in JSON, as UTF-8 if possible, else with the encoding detected by chardet"""
+    if isinstance(x, str) and not isinstance(x, unicode):
+        try:
+            return x.decode('utf-8')
+        except UnicodeDecodeError:
+            return x.decode(chardet.detect(x)['encoding'] or 'latin-1')
+    return x
+
+def serialize_multivalue(x):
+    """Serialize a multi-valued cell (list, tuple or set) as a string in the multi-value format, which is MULTIVALUE_PREFIX followed by a JSON list (eg, @mv["a", 1, null]), human readable and very fast to parse back with parse_multivalue(). Values that are not supported by JSON (eg, dates) are converted to strings.
+    Strings that could be mistaken for a serialized cell (ie, starting with @mv[, or with backslashes followed by @mv[) are escaped by prepending a backslash, so that any string is parsed back as-is. Other values are returned as-is."""
+    if isinstance(x, (list, tuple, set)):
+        return MULTIVALUE_PREFIX + json.dumps([_multivalue_item(y) for y in x], ensure_ascii=False, default=_str)
+    if isinstance(x, basestring) and _MULTIVALUE_ESCAPE_REGEX.match(x):
+        return '\\' + x
+    return x
+
+def parse_multivalue(x):
+    """Parse a cell in the multi-value format (see serialize_multivalue()) back into a list, and unescape the escaped strings. Any other value is returned as-is (in particular, strings that merely look like lists are not parsed, see multivalue_eval() for that)."""
+    if isinstance(x, basestring) and x.startswith(('@', '\\')):
+        if x.startswith(MULTIVALUE_PREFIX + '['):
+            try:
+                res = json.loads(x[len(MULTIVALUE_PREFIX):])
+                if isinstance(res, list):
+                    return res
+            except ValueError:
+                pass
+        elif _MULTIVALUE_ESCAPE_REGEX.match(x):
+            return x[1:]
+    return x
+
+def _df_map_multivalue(df_in, cols, func):
+    """Apply func on the cells of the object columns of a dataframe (or of the specified cols) that are multi-valued or strings, each distinct string only once. Columns are processed by position, so that duplicated column names are supported."""
+    df = df_in.copy()
+    for pos, col in enumerate(df.columns):
+        if cols is not None and col not in cols:
+            continue
+        values = df.iloc[:, pos]
+        if values.dtype.name not in ('object', 'string', 'str'):
+            # Not a strings column
+            continue
+        mapping = {}
+        changed = False
+        res = []
+        for x in values.values:
+            if isinstance(x, basestring):
+                if x not in mapping:
+                    mapping[x] = func(x)
+                y = mapping[x]
+            elif isinstance(x, (list, tuple, set)):
+                y = func(x)
+            else:
+                y = x
+            changed = changed or y is not x
+            res.append(y)
+        if changed:
+            _df_set_column(df, pos, res)
+    return df
+
+def df_serialize_multivalue(df_in, cols=None):
+    """Serialize all the multi-valued cells (lists, tuples and sets) of the object columns of a dataframe (or of the specified cols) with serialize_multivalue() (which also escapes the strings that could be mistaken for serialized cells)"""
+    return _df_map_multivalue(df_in, cols, serialize_multivalue)
+
+def df_parse_multivalue(df_in, cols=None):
+    """Parse all the cells in the multi-value format (see serialize_multivalue()) of the object columns of a dataframe (or of the specified cols) back into lists, each distinct string being parsed only once"""
+    return _df_map_multivalue(df_in, cols, parse_multivalue)
+
+def load_df_from_csv(input_file, multivalue=True, **kwargs):
+    """Load a dataframe from a csv saved with save_df_as_csv(), dropping the empty rows. If multivalue is True, the cells in the multi-value format are loaded back as lists (see df_parse_multivalue()), other cells being left untouched.
+    Any additional argument is passed to pd.read_csv()."""
+    kwargs.setdefault('sep', ';')
+    kwargs.setdefault('low_memory', False)
+    df = pd.read_csv(input_file, **kwargs).dropna(how='all')
+    if multivalue:
+        df = df_parse_multivalue(df)
+    return df
+
+def _file_md5(path, blocksize=1048576):
+    """Compute the md5 hash of a file, reading it by blocks"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _db_sidecar_path(path):
+    """Path of the binary sidecar of a csv database (see save_db() and load_db())"""
+    return path + '.cache'
+
+def _db_load_params(unicode_fix=True, schema=None, **kwargs):
+    """Loading parameters of load_db() recorded in the sidecars, to not reuse a sidecar built with other parameters"""
+    return (bool(unicode_fix), repr(list(schema.items()) if isinstance(schema, dict) else schema), repr(sorted(kwargs.items())))
+
+def _db_sidecar_write(df, path, params):
+    """Write the binary sidecar of the csv database at path, recording the signature of the csv (modification time, size and md5 hash) so that load_db() can check that it is still up to date"""
+    sidecar = {'mtime': os.path.getmtime(path),
+               'size': os.path.getsize(path),
+               'md5': _file_md5(path),
+               'params': params,
+               'df': df,
+              }
+    with open(_db_sidecar_path(path), 'wb') as f:
+        pickle.dump(sidecar, f, pickle.HIGHEST_PROTOCOL)
+
+def _db_sidecar_read(path, params):
+    """Return the dataframe stored in the binary sidecar of the csv database at path if it is still up to date (same loading parameters, and the csv has the same modification time and size, or else the same md5 hash), or None otherwise"""
+    sidecar_path = _db_sidecar_path(path)
+    if not os.path.isfile(sidecar_path):
+        return None
+    try:
+        with open(sidecar_path, 'rb') as f:
+            sidecar = pickle.load(f)
+    except Exception as exc:
+        # Truncated or incompatible sidecar, it will be rebuilt
+        return None
+    if sidecar.get('params') != params or sidecar.get('size') != os.path.getsize(path):
+        return None
+    if sidecar.get('mtime') != os.path.getmtime(path) and sidecar.get('md5') != _file_md5(path):
+        return None
+    return sidecar['df']
+
+def save_db(df, output_file, **kwargs):
+    """Save a database dataframe as a csv with save_df_as_csv() (any additional argument is passed to it), plus a binary sidecar (output_file + '.cache') so that load_db() can load it back without parsing the csv nor fixing its encoding.
+    The sidecar is built by loading the written csv with load_db() (with its default arguments), so that it holds exactly what load_db() would return from the csv.
+    Returns the path of the csv."""
+    if kwargs.get('excel', False):
+        raise ValueError('save_db() only supports csv databases, use save_df_as_csv() to save as excel.')
+    if output_file.endswith('.csv.gz'):
+        kwargs['compress'] = True
+        output_file = output_file[:-len('.gz')]
+    if not output_file.endswith('.csv'):
+        output_file += '.csv'
+    if kwargs.get('compress', False):
+        output_file += '.gz'
+    save_df_as_csv(df, output_file, **kwargs)
+    load_db(output_file, cache=True)
+    return output_file
+
+def load_db(input_file, unicode_fix=True, schema=None, cache=True, verbose=False, **kwargs):
+    """Load a database csv as load_df_from_csv() does (any additional argument is passed to it, eg, usecols to load only some columns), followed by df_to_unicode_fast() if unicode_fix is True.
+    If schema is True (or a schema, see DB_SCHEMA), the known columns are then converted to their typed dtypes with df_apply_schema(), and if verbose is True the memory usage before and after is printed (see df_memory_report()).
+    If the csv has an up to date binary sidecar (written by save_db(), or by a previous load_db() with the same arguments), the dataframe is loaded from it instead, skipping both the parsing and the unicode fixing. The sidecar is considered up to date if the csv has the same size and modification time, or the same md5 hash, as when the sidecar was written.
+    If cache is True and there is no up to date sidecar, one is written after loading the csv."""
+    params = _db_load_params(unicode_fix, schema, **kwargs)
+    if cache:
+        df = _db_sidecar_read(input_file, params)
+        if df is not None:
+            if verbose:
+                print('Loaded %s from its binary sidecar.' % input_file)
+            return df
+    df = load_df_from_csv(input_file, **kwargs)
+    if unicode_fix:
+        df = df_to_unicode_fast(df, source=input_file)
+    if schema is not None and schema is not False:
+        df_typed = df_apply_schema(df, schema=(None if schema is True else schema), verbose=verbose)
+        if verbose:
+            print(df_memory_report(df, df_typed).loc['total'])
+        df = df_typed
+    if cache:
+        try:
+            _db_sidecar_write(df, input_file, params)
+        except (IOError, OSError, pickle.PicklingError) as exc:
+            if verbose:
+                print('Warning: cannot write the binary sidecar of %s: %s' % (input_file, exc))
+    return df
+
+def _csv_read_chunks(input_file, unicode_fix=True, sep=';', chunksize=None, nrows=None):
+    """Read a csv by chunks of chunksize rows (or only its header with nrows=0), keeping all the cells as text exactly as written (no type inference nor null values conversion, empty cells are empty strings), and optionally decoding them to unicode with df_to_unicode_fast() (the column names included).
+    The encoding of each column is detected only once per file (on its first chunk with non-ascii strings) and reused for all the next chunks, through the encodings cache keyed by source, so that all the chunks of a column are decoded the same way. These encodings are stored in the sidecar of the file (see df_to_unicode_fast()) once it has been read entirely."""
+    if unicode_fix and os.path.isfile(input_file):
+        _encodings_sidecar_load(input_file)
+    reader = pd.read_csv(input_file, sep=sep, dtype=object, na_filter=False, chunksize=chunksize, nrows=nrows)
+    detected = False
+    for chunk in ([reader] if chunksize is None else reader):
+        if unicode_fix and len(chunk) == 0:
+            # Header only (eg, nrows=0): there is no value to decode, only clean the column names as df_to_unicode_fast() does (its index reset/restore fails on the empty object index of pandas 0.23)
+            chunk.columns = [unicode(cleanup_name(x, normalize=False, clean_nonletters=False), errors='ignore') for x in chunk.columns]
+        elif unicode_fix:
+            chunk = df_to_unicode_fast(chunk, source=input_file, persist=False)
+            # A column with only ascii strings so far is not conclusive, its encoding will be detected again on the next chunk
+            for col in chunk.columns:
+                cache_key = _encodings_cache_key(input_file, col)
+                if _encodings_cache._data.get(cache_key, 'ascii') in ('ascii', None):
+                    _encodings_cache.discard(cache_key)
+                else:
+                    detected = True
+        yield chunk
+    if detected and nrows is None and os.path.isfile(input_file):
+        _encodings_sidecar_save(input_file)
+
+def append_csv_databases(inputs, output_file, unicode_fix=True, chunksize=10000, encoding='utf-8-sig', compress=False, verbose=False):
+    """Concatenate csv databases (eg, to append one database to another) into output_file, by streaming their rows by chunks of chunksize rows, so that the memory usage does not depend on the size of the databases.
+    The columns are the union of the columns of all the inputs, in their order of appearance (as pd.concat(sort=False)), computed from the header lines only, and each chunk is reordered accordingly (with empty cells for the columns an input does not have). The cells are kept as text exactly as written (no type inference, so eg integers are not converted to floats), empty rows are dropped, and if unicode_fix is True the strings are decoded with df_to_unicode_fast() (the encoding of each column being detected once per input, see _csv_read_chunks()) and written in the output encoding.
+    The output can be one of the inputs, it is written to a temporary file replacing it at the end. If compress is True (or if output_file ends with .gz), the output is gzipped (and .gz is appended to its name)."""
+    if isinstance(inputs, basestring):
+        inputs = [inputs]
+    if output_file.endswith('.gz'):
+        compress = True
+    elif compress:
+        output_file += '.gz'
+    # Union of the columns, from the header lines only
+    columns = []
+    columns_check = set()
+    for input_file in inputs:
+        header = next(_csv_read_chunks(input_file, unicode_fix=unicode_fix, nrows=0))
+        for col in header.columns:
+            if col not in columns_check:
+                columns_check.add(col)
+                columns.append(col)
+    if verbose:
+        print('CSV fields order: '+str(columns))
+    # Stream the rows of each input
+    with _atomic_open(output_file, compress=compress) as f:
+        f.write(_df_csv_chunk(pd.DataFrame(columns=columns), columns, first=True, encoding=encoding))
+        for input_file in inputs:
+            count = 0
+            for chunk in _csv_read_chunks(input_file, unicode_fix=unicode_fix, chunksize=chunksize):
+                # Drop the empty rows
+                chunk = chunk[(chunk != '').any(axis=1)]
+                count += len(chunk)
+                f.write(_df_csv_chunk(chunk.reindex(columns=columns, fill_value=''), columns, first=False, encoding=encoding))
+            if verbose:
+                print('Appended %i rows from %s.' % (count, input_file))
+    return True
+
+# Known columns of the databases and their typed dtype, as an ordered dict of regex pattern -> dtype, the first pattern found in a column name defining its dtype (see df_apply_schema())
+DB_SCHEMA = OrderedDict([
+    # Diagnoses, etiologies, sedation and other small sets of labels
+    (r'^unified\.diagnosis_(best|worst)$', 'category'),
+    (r'^unified\.(etiology|gender|acute)$', 'category'),
+    (r'sedation', 'category'),
+    # Dates
+    (r'^unified\.diagnoses_(first|last)(best|worst)?diag$', 'datetime'),
+    (r'(^|[._ ])([a-z]+_)*(birth)?dates?(_end)?$', 'datetime'),
+    # Counts and scores
+    (r'^unified\.diagnoses_count(_withdate)?$', 'Int64'),
+    (r'crs.*(score|total)$', 'Int64'),
+    (r'^unified\.age$', 'float'),
+])
+
+# Strings that stand for null values (see df_fillnastr())
+NULL_STRINGS = ['None', 'NONE', 'none', 'NaN', 'nan', 'NaT', 'nat', 'na', 'NA', 'N/A', '#VALUE!']
+
+def db_schema_dtypes(columns, schema=None):
+    """Return an OrderedDict of the columns which dtype is defined by the schema (by default DB_SCHEMA) -> dtype"""
+    if schema is None:
+        schema = DB_SCHEMA
+    regexes = [(re.compile(pattern), dtype) for pattern, dtype in schema.items()]
+    dtypes = OrderedDict()
+    for col in columns:
+        for regex, dtype in regexes:
+            if isinstance(col, basestring) and regex.search(col):
+                dtypes[col] = dtype
+                break
+    return dtypes
+
+def _schema_convert(serie, dtype):
+    """Convert a Series to the dtype of a schema, or return None if the conversion would lose any value. Empty and null strings (see NULL_STRINGS) are considered null values for dates and numbers."""
+    if dtype == 'category':
+        try:
+            return serie.astype('category')
+        except TypeError:
+            # Unhashable values, such as multi-valued cells
+            return None
+    isnull = pd.Series(_blankna_mask(serie, strings=frozenset(NULL_STRINGS + [''])), index=serie.index)
+    values = serie.where(~isnull)
+    if dtype == 'datetime':
+        if serie.dtype.name.startswith('datetime'):
+            return serie
+        stats = {}
+        parsed = date_clean_serie(values, route_stats=stats)
+        if stats.get('failed', 0) or stats.get('empty', 0):
+            return None
+        try:
+            return pd.to_datetime(parsed)
+        except (ValueError, TypeError):
+            return None
+    if dtype in ('Int64', 'float'):
+        numbers = pd.to_numeric(values, errors='coerce')
+        if (numbers.isnull() & ~isnull).any():
+            return None
+        if dtype == 'Int64':
+            if not (numbers.dropna() % 1 == 0).all():
+                return numbers.astype('float')
+            if hasattr(pd, 'Int64Dtype'):
+                try:
+                    return numbers.astype('Int64')
+                except (TypeError, ValueError):
+                    pass
+            # Nullable integers are not supported by this version of pandas (before 0.24, 'Int64' is numpy's int64, which fails on null values)
+            return numbers.astype('float') if isnull.any() else numbers.astype('int64')
+        return numbers.astype('float')
+    return serie.astype(dtype)
+
+def df_apply_schema(df, schema=None, verbose=False):
+    """Convert the known columns of a dataframe to their typed dtype defined by the schema (by default DB_SCHEMA, see db_schema_dtypes()), to reduce the memory usage (eg, diagnoses as categories instead of Python strings) and get directly usable columns (dates as datetime64, scores as nullable integers).
+    A column is converted only if no value is lost (empty and null strings such as 'None' become null values for dates and numbers), else it is kept as-is (and reported if verbose is True)."""
+    df = df.copy()
+    for col, dtype in db_schema_dtypes(df.columns, schema=schema).items():
+        converted = _schema_convert(df[col], dtype)
+        if converted is None:
+            if verbose:
+                print('Warning: column %s cannot be converted to %s without losing values, it is kept as %s.' % (col, dtype, df[col].dtype.name))
+        else:
+            df[col] = converted
+    return df
+
+def df_memory_report(df_before, df_after):
+    """Compare the memory usage of the columns of a dataframe before and after a conversion (eg, df_apply_schema()), including the memory of the Python objects (ie, deep memory usage). Returns a dataframe of the dtypes and bytes before and after and their ratio for each column, plus a 'total' row."""
+    before = df_before.memory_usage(index=False, deep=True)
+    after = df_after.memory_usage(index=False, deep=True)
+    report = pd.DataFrame(OrderedDict([('dtype_before', df_before.dtypes.astype('str')),
+                                       ('dtype_after', df_after.dtypes.astype('str')),
+                                       ('bytes_before', before),
+                                       ('bytes_after', after),
+                                      ]))
+    report.loc['total'] = ['', '', before.sum(), after.sum()]
+    report['ratio'] = report['bytes_after'] / report['bytes_before'].astype('float')
+    return report
+
+def multivalue_eval(x):
+    """Evaluate a cell as a Python object like df_literal_eval(), but return multi-valued cells that are already lists (or tuples or sets) as-is, and parse the strings in the multi-value format without ast"""
+    if isinstance(x, (list, tuple, set)):
+        return x
+    res = parse_multivalue(x)
+    if res is not x:
+        return res
+    return df_literal_eval(x)
+
 def df_cols_lower(df_in, col='name'):
     """Find in a DataFrame any column matching the col argument in lowercase and rename all found columns to lowercase"""
     # Make a copy to avoid tampering the original
@@ -1108,11 +2794,60 @@ def date_clean(s):
                         print('Warning: Failed parsing this date: %s' % s)
                         return None
 
-def df_date_clean(df_in, col):
-    """Apply fuzzy date cleaning (and datetype conversion) to a dataframe's column"""
+# Fast parsing routes of date_clean_serie(): (name, regex matching the cleaned date, pd.to_datetime() format), the formats we see most
+DATE_CLEAN_FAST_ROUTES = [
+    ('iso', r'^\d{4}-\d{2}-\d{2}$', '%Y-%m-%d'),
+    ('dmy', r'^\d{2}/\d{2}/\d{4}$', '%d/%m/%Y'),
+    ('ymd', r'^\d{8}$', '%Y%m%d'),
+]
+
+def date_clean_serie(serie, route_stats=None):
+    """Apply date_clean() on a whole Series (or list), with the same results but much faster: each distinct value is parsed only once, and the dates in the most common formats (see DATE_CLEAN_FAST_ROUTES) are parsed at once with pd.to_datetime(), only the leftovers are parsed with date_clean() (dateutil fuzzy parsing).
+    If a route_stats dict is provided, the number of distinct values parsed by each route ('iso', 'dmy', 'ymd', 'dateutil', plus 'failed' for unparseable values and 'empty' for values without any date character) is accumulated in it."""
+    if not isinstance(serie, pd.Series):
+        serie = pd.Series(serie)
+    if route_stats is None:
+        route_stats = {}
+    uniques = pd.Series(serie.dropna().unique(), dtype='object')
+    if len(uniques) == 0:
+        return serie.map(lambda x: None)
+    # Clean non date characters, the same way as date_clean() (date_fr2en() is skipped because it has no effect, the cleaned dates do not contain any letter)
+    cleaned = uniques.map(str).str.lower().str.findall(r'[\d/-:\s]+', flags=re.UNICODE).str.join('-')
+    parsed = [None] * len(uniques)
+    todo = pd.Series(True, index=uniques.index)
+    empty = cleaned == ''
+    route_stats['empty'] = route_stats.get('empty', 0) + int(empty.sum())
+    todo &= ~empty
+    # Fast routes: parse at once all the dates that match a common format
+    for route, regex, fmt in DATE_CLEAN_FAST_ROUTES:
+        mask = todo & cleaned.str.match(regex)
+        if mask.any():
+            dates = pd.to_datetime(cleaned[mask], format=fmt, errors='coerce')
+            dates = dates[dates.notnull()]  # invalid dates are left to the slow route
+            for i, date in zip(dates.index, dates.dt.to_pydatetime()):
+                parsed[i] = date
+            todo[dates.index] = False
+            route_stats[route] = route_stats.get(route, 0) + len(dates)
+    # Slow route: dateutil fuzzy parsing of the leftovers
+    for i in todo[todo].index:
+        parsed[i] = date_clean(uniques[i])
+        if parsed[i] is None:
+            route_stats['failed'] = route_stats.get('failed', 0) + 1
+        else:
+            route_stats['dateutil'] = route_stats.get('dateutil', 0) + 1
+    # Map back the parsed dates on all cells
+    mapping = dict(zip(uniques, parsed))
+    return serie.map(lambda x: mapping.get(x) if not pd.isnull(x) else None)
+
+def df_date_clean(df_in, col, route_stats=None, verbose=False):
+    """Apply fuzzy date cleaning (and datetype conversion) to a dataframe's column, see date_clean_serie() (route_stats is filled with the number of distinct values parsed per route, and printed if verbose)"""
     # Make a copy to avoid tampering the original
     df = df_in.copy()
-    df[col] = df[col].apply(date_clean).astype('datetime64')
+    if route_stats is None:
+        route_stats = {}
+    df[col] = date_clean_serie(df[col], route_stats=route_stats).astype('datetime64[ns]')
+    if verbose:
+        print('Date parsing routes: %s' % ', '.join('%s=%i' % (k, v) for k, v in sorted(route_stats.items())))
     return df
 
 def clean_integer_score(x):
@@ -1158,13 +2893,41 @@ def df_unify(df, cols, unicol):
 
 def df_replace_nonnull(x, repmap, cleanup=False):
     if cleanup and isinstance(x, str):
-        x = cleanup_name(replace_buggy_accents(x))
+        x = normalize_name(x)
     if x in repmap:
         replacement = repmap[x]
         return replacement if replacement is not None else x
     else:
         return x
 
+def _multi_pattern_matcher(patterns, batch_size=40):
+    """Compile a list of regex patterns into a function returning the sorted indices of all the patterns found in a string (as with re.search), testing each batch of patterns with a single combined regex: each pattern is a named group in an optional lookahead, so that one match call tells which patterns are present.
+    Patterns containing their own groups (which could be backreferenced), global inline flags (eg, (?i), which would apply to the whole combined regex) or that cannot be combined are matched separately."""
+    matchers = []
+    for b in range(0, len(patterns), batch_size):
+        batch = [(b + i, re.compile(p)) for i, p in enumerate(patterns[b:b+batch_size])]
+        # The flags of a pattern differ from the default flags of its type of string (str or unicode) only if it sets global inline flags
+        combinable = [(i, r) for i, r in batch if r.groups == 0 and r.flags == re.compile(r.pattern[:0]).flags]
+        if combinable:
+            try:
+                combined = re.compile(''.join('(?:(?=[\s\S]*?(?P<_p%i>%s)))?' % (i, r.pattern) for i, r in combinable))
+                matchers.append((combined, [(i, '_p%i' % i) for i, r in combinable]))
+            except (re.error, AssertionError, OverflowError):
+                # Too many groups for this version of re
+                combinable = []
+        matchers.extend((r, i) for i, r in batch if (i, r) not in combinable)
+
+    def find_all(s):
+        found = []
+        for regex, groups in matchers:
+            if isinstance(groups, list):
+                m = regex.match(s)
+                found.extend(i for i, g in groups if m.group(g) is not None)
+            elif regex.search(s):
+                found.append(groups)
+        return sorted(found)
+    return find_all
+
 def df_translate(df, col, mapping, cleanup=False, partial=False):
     """Translate a list of strings on a Dataframe's column
     This can for example be used to simplify all the values to a reduced set, for more comprehensible graphs or easier data organization
@@ -1172,11 +2935,37 @@ def df_translate(df, col, mapping, cleanup=False, partial=False):
     df2 = df.copy()
     if not partial:
         # Exact match required
-        df2[col] = df2[col].apply(lambda x: df_replace_nonnull(x, mapping, cleanup=cleanup))
+        values = df2[col]
+        if cleanup:
+            # Clean up all the distinct str values at once, with one encoding detection for the whole column
+            isstr = values.apply(lambda x: isinstance(x, str)).values
+            cleaned = cleanup_names(values[isstr], fix_accents=True)
+            values = values.copy()
+            values[isstr] = cleaned
+        df2[col] = values.apply(lambda x: df_replace_nonnull(x, mapping))
     else:
-        # Partial match OK
-        for pattern, replacement in mapping.items():
-            df2.loc[df2[col].str.contains(pattern), col] = replacement
+        # Partial match OK: all the patterns are searched at once in each distinct value, then the replacements are applied in the order of mapping, each replaced value being further matched against the next patterns only
+        patterns = list(mapping.keys())
+        replacements = list(mapping.values())
+        find_all = _multi_pattern_matcher(patterns)
+        found_cache = {}
+
+        def translate(x):
+            start = 0
+            while isinstance(x, basestring):
+                if (type(x), x) not in found_cache:
+                    found_cache[(type(x), x)] = find_all(x)
+                found = [i for i in found_cache[(type(x), x)] if i >= start]
+                if not found:
+                    break
+                x = replacements[found[0]]
+                start = found[0] + 1
+            return x
+        translated = {}
+        for x in df2[col].values:
+            if isinstance(x, basestring) and (type(x), x) not in translated:
+                translated[(type(x), x)] = translate(x)
+        df2[col] = pd.Series([(translated[(type(x), x)] if isinstance(x, basestring) else x) for x in df2[col].values], index=df2.index, dtype='object')
     return df2
 
 def filter_nan_str(x):
@@ -1188,7 +2977,7 @@ def filter_nan_str(x):
 
 def df_filter_nan_str(df_col):
     """Filter all 'nan' values as strings from a Dataframe column containing lists"""
-    return df_col.apply(df_literal_eval).apply(filter_nan_str).astype('str')
+    return df_col.apply(multivalue_eval).apply(filter_nan_str).astype('str')
 
 def df_squash_lists(df_col_in, func=None, aggressive=False):
     """Filter lists enclosed in Dataframe column by first evaluating the strings as a list and then applying the supplied function to choose which element to return"""
@@ -1198,12 +2987,12 @@ def df_squash_lists(df_col_in, func=None, aggressive=False):
     df_col = df_col_in.copy()
     if aggressive:
         df_col = df_col.astype('str').str.replace("[\[\]{}']", '')
-    return df_col.apply(df_literal_eval).apply(lambda x: func(x) if isinstance(x, (list, set, tuple)) else x).astype('str')
+    return df_col.apply(multivalue_eval).apply(lambda x: func(x) if isinstance(x, (list, set, tuple)) else x).astype('str')
 
 def df_fillnastr(df_col_in, replacement=None):
     """Replace null values hidden in strings with the provided replacement value"""
     df_col = df_col_in.copy()
-    df_col[df_col.isna() | (df_col == 'None') | (df_col == 'NONE') | (df_col == 'none') | (df_col == 'NaN') | (df_col == 'nan') | (df_col == 'NaT') | (df_col == 'nat') | (df_col == 'na') | (df_col == 'NA') | (df_col == 'N/A') | (df_col == '#VALUE!')] = replacement
+    df_col[_blankna_mask(df_col, strings=frozenset(NULL_STRINGS))] = replacement
     return df_col
 
 
@@ -1231,7 +3020,7 @@ def generate_path_from_dicom_fields(output_dir, dcmdata, key_dicom_fields, clean
                 dcmfieldval = placeholder_value
             # Cleanup the dicom field is enabled (this will replace accentuated characters, most english softwares do not support those)
             if cleanup_dicom_fields:
-                dcmfieldval = cleanup_name(dcmfieldval)
+                dcmfieldval = normalize_name(dcmfieldval, fix_accents=False)
             # Add the path parts to the list
             innerpathparts.append(dcmfieldval)
         # Concatenate the inner path parts and add to the outer path parts list
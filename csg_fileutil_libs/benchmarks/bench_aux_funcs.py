@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the names processing functions of aux_funcs.
+
+The Time* classes follow the asv layout (setup() then time_* methods), and the module can also be run as a script to print a comparison with the legacy implementation:
+
+    python -m csg_fileutil_libs.benchmarks.bench_aux_funcs [number_of_names]
+"""
+
+from __future__ import absolute_import, print_function
+
+import random
+import sys
+import timeit
+
+from csg_fileutil_libs import aux_funcs
+
+
+FIRST_NAMES = ['Jean', 'Marie', 'Pierre', 'François', 'Hélène', 'Jérôme', 'Cécile', 'Noël', 'Anaïs', 'Amélie', 'Gérard', 'Stéphane', 'Anne-Sophie', 'Jean-Luc', 'Zoé', 'Loïc', 'Maëlle', 'Thérèse']
+LAST_NAMES = ['Dupont', 'Lefèvre', 'Hébert', 'Lemaître', 'Dupré', 'Bézier', 'Müller', 'Van den Broeck', "D'Hondt", 'Peeters', 'Janssens', 'Nguyên', 'Côté', 'Gauthier-Lévêque', 'Smets', 'De Clercq']
+
+
+def make_names_corpus(n=5000, buggy_ratio=0.3, seed=0):
+    """Generate a realistic corpus of n patient names (utf-8 str), formatted as in the databases ("Last, First") or in the dicoms ("LAST^FIRST"), with repeated names, and buggy_ratio of them carrying a buggy accent (see aux_funcs.BUGGY_ACCENTS)"""
+    rnd = random.Random(seed)
+    buggy = [x.decode('utf-8') for x in sorted(aux_funcs.BUGGY_ACCENTS)]
+    # Draw from a pool of distinct patients, so that names repeat as in the real databases (one row per session)
+    pool = []
+    for _ in range(max(n // 4, 1)):
+        first, last = rnd.choice(FIRST_NAMES).decode('utf-8'), rnd.choice(LAST_NAMES).decode('utf-8')
+        dicom = rnd.random() < 0.3
+        if dicom:
+            first, last = first.upper(), last.upper()
+        if rnd.random() < buggy_ratio:
+            # Replace a letter by a buggy accent
+            pos = rnd.randrange(len(last))
+            last = last[:pos] + rnd.choice(buggy) + last[pos+1:]
+        pool.append((u'%s^%s' % (last, first) if dicom else u'%s, %s' % (last, first)).encode('utf-8'))
+    return [rnd.choice(pool) for _ in range(n)]
+
+
+def legacy_replace_buggy_accents(s, encoding=None):
+    """The previous implementation of replace_buggy_accents(), one str.replace() per pattern (the patterns being converted for each string), kept as the reference of the benchmark"""
+    dic_replace = aux_funcs.BUGGY_ACCENTS
+    if isinstance(s, unicode):
+        dic_replace = {k.decode('utf-8'): v.decode('utf-8') for k,v in dic_replace.items()}
+    for pat, rep in dic_replace.items():
+        if encoding:
+            pat = pat.decode(encoding)
+            rep = rep.decode(encoding)
+        s = s.replace(pat, rep)
+    return s
+
+
+class TimeReplaceBuggyAccents(object):
+    """Time tests for replace_buggy_accents() and replace_buggy_accents_serie() on str names."""
+    isunicode = False
+
+    def setup(self, n=5000):
+        self.names = make_names_corpus(n)
+        if self.isunicode:
+            self.names = [x.decode('utf-8') for x in self.names]
+
+    def time_legacy(self):
+        for x in self.names:
+            legacy_replace_buggy_accents(x)
+
+    def time_replace_buggy_accents(self):
+        for x in self.names:
+            aux_funcs.replace_buggy_accents(x)
+
+    def time_replace_buggy_accents_serie(self):
+        aux_funcs.replace_buggy_accents_serie(self.names)
+
+
+class TimeReplaceBuggyAccentsUnicode(TimeReplaceBuggyAccents):
+    """Time tests for replace_buggy_accents() and replace_buggy_accents_serie() on unicode names."""
+    isunicode = True
+
+
+def main(n=5000, repeat=5):
+    """Print the best time of repeat runs of each benchmark on a corpus of n names"""
+    print('Corpus of %i names, best of %i runs' % (n, repeat))
+    for bench_class in [TimeReplaceBuggyAccents, TimeReplaceBuggyAccentsUnicode]:
+        bench = bench_class()
+        bench.setup(n)
+        for name in ['time_legacy', 'time_replace_buggy_accents', 'time_replace_buggy_accents_serie']:
+            best = min(timeit.repeat(getattr(bench, name), number=1, repeat=repeat))
+            print('%s.%s: %.4fs' % (bench_class.__name__, name, best))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(x) for x in sys.argv[1:2]]))
@@ -1,14 +1,16 @@
 "Utilities for comparing sequences"
 
 __all__ = ["hamming", "levenshtein", "nlevenshtein", "jaccard", "sorensen",
-	"fast_comp", "lcsubstrings", "ilevenshtein", "ifast_comp"]
+	"fast_comp", "lcsubstrings", "ilevenshtein", "ifast_comp",
+	"levenshtein_many", "nlevenshtein_many", "nlevenshtein_within"]
 
 try:
 	from .cdistance import *
 except ImportError:
 	from ._pyimports import *
 
-from ._pyimports import jaccard, sorensen
+from ._pyimports import jaccard, sorensen, nlevenshtein_within
+from ._bitparallel import levenshtein_many, nlevenshtein_many
 
 def quick_levenshtein(str1, str2):
 	return fast_comp(str1, str2, transpositions=False)
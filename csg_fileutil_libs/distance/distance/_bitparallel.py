@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+__all__ = ["levenshtein_many", "nlevenshtein_many"]
+
+WORD_SIZE = 64
+
+
+def _encode(query, candidates):
+	"""Map the symbols of the query to small integer ids (0 being reserved for
+	symbols absent from the query), and build the candidates matrix of ids
+	padded with zeros, along with the candidates lengths."""
+	ids = {}
+	for sym in query:
+		if sym not in ids:
+			ids[sym] = len(ids) + 1
+	lens = np.fromiter((len(c) for c in candidates), dtype=np.int64, count=len(candidates))
+	maxlen = int(lens.max()) if len(lens) else 0
+	text = np.zeros((len(candidates), maxlen), dtype=np.int64)
+	for i, cand in enumerate(candidates):
+		if lens[i]:
+			text[i, :lens[i]] = [ids.get(sym, 0) for sym in cand]
+	return ids, text, lens
+
+
+def _peq(query, ids):
+	"""Build the pattern match bitvectors of the query, one row per symbol id
+	and one column per 64-bit word."""
+	nwords = max(1, (len(query) + WORD_SIZE - 1) // WORD_SIZE)
+	peq = np.zeros((len(ids) + 1, nwords), dtype=np.uint64)
+	for pos, sym in enumerate(query):
+		peq[ids[sym], pos // WORD_SIZE] |= np.uint64(1) << np.uint64(pos % WORD_SIZE)
+	return peq
+
+
+def levenshtein_many(query, candidates):
+	"""Compute the absolute Levenshtein distance between the sequence `query`
+	and each sequence in `candidates`, all at once, and return them as a NumPy
+	array of integers in the same order as `candidates`.
+
+	The distances are the same as `levenshtein(query, candidate)`, but they are
+	computed with the bit-parallel algorithm of Myers (1999), extended to
+	queries longer than 64 symbols with the blocks of Hyyrö (2003), and
+	vectorized over all the candidates with NumPy. This makes scoring one
+	sequence against thousands of others orders of magnitude faster than
+	calling `levenshtein` in a loop. Requires NumPy.
+	"""
+	if np is None:
+		raise ImportError("levenshtein_many requires numpy")
+	candidates = list(candidates)
+	m = len(query)
+	ids, text, lens = _encode(query, candidates)
+	if m == 0 or len(candidates) == 0:
+		return lens.copy()
+
+	peq = _peq(query, ids)
+	n, nwords = len(candidates), peq.shape[1]
+	one = np.uint64(1)
+	shift = np.uint64(WORD_SIZE - 1)
+	lastbit = np.uint64((m - 1) % WORD_SIZE)
+	# Vertical deltas of the DP columns: all +1 at the start (D[i][0] = i)
+	Pv = np.full((nwords, n), np.iinfo(np.uint64).max, dtype=np.uint64)
+	Mv = np.zeros((nwords, n), dtype=np.uint64)
+	score = np.full(n, m, dtype=np.int64)
+
+	for j in range(text.shape[1]):
+		Eqs = peq[text[:, j]].T
+		# Horizontal delta entering the first block is always +1 (D[0][j] = j)
+		hin_p = np.ones(n, dtype=bool)
+		hin_m = np.zeros(n, dtype=bool)
+		for b in range(nwords):
+			hibit = lastbit if b == nwords - 1 else shift
+			Eq = Eqs[b] | hin_m.astype(np.uint64)
+			pv, mv = Pv[b], Mv[b]
+			Xv = Eqs[b] | mv
+			Xh = (((Eq & pv) + pv) ^ pv) | Eq
+			Ph = mv | ~(Xh | pv)
+			Mh = pv & Xh
+			hout_p = ((Ph >> hibit) & one).astype(bool)
+			hout_m = ((Mh >> hibit) & one).astype(bool)
+			Ph = (Ph << one) | hin_p.astype(np.uint64)
+			Mh = (Mh << one) | hin_m.astype(np.uint64)
+			Pv[b] = Mh | ~(Xv | Ph)
+			Mv[b] = Ph & Xv
+			hin_p, hin_m = hout_p, hout_m
+		# Only the candidates that still have symbols left are updated
+		active = lens > j
+		score += (hin_p & active).astype(np.int64) - (hin_m & active).astype(np.int64)
+	return score
+
+
+def nlevenshtein_many(query, candidates, max_dist=None):
+	"""Compute the normalized Levenshtein distance between the sequence `query`
+	and each sequence in `candidates`, and return them as a NumPy array of floats
+	in the same order as `candidates`.
+
+	The values are the same as `nlevenshtein(query, candidate, method=1)`, ie,
+	the edit distance divided by the length of the longest sequence, but they are
+	computed all at once with `levenshtein_many`.
+
+	If `max_dist` is provided, the candidates whose normalized distance is higher
+	than `max_dist` get -1 instead, similarly to `levenshtein`. The candidates that
+	cannot reach `max_dist` because of their length difference alone are discarded
+	beforehand, without computing their distance.
+	"""
+	if np is None:
+		raise ImportError("nlevenshtein_many requires numpy")
+	candidates = list(candidates)
+	m = len(query)
+	lens = np.fromiter((len(c) for c in candidates), dtype=np.int64, count=len(candidates))
+	longest = np.maximum(lens, m)
+	res = np.zeros(len(candidates), dtype=np.float64)
+	todo = longest > 0  # two empty sequences are equal
+	if max_dist is not None:
+		res[:] = -1.0
+		res[longest == 0] = 0.0
+		todo &= np.abs(lens - m) / np.maximum(longest, 1).astype(np.float64) <= max_dist
+	idx = np.flatnonzero(todo)
+	if len(idx):
+		dists = levenshtein_many(query, [candidates[i] for i in idx])
+		res[idx] = dists / longest[idx].astype(np.float64)
+	if max_dist is not None:
+		res[todo & (res > max_dist)] = -1.0
+	return res
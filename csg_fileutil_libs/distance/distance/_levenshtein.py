@@ -138,3 +138,62 @@ def nlevenshtein(seq1, seq2, method=1):
 			llast = lold
 	
 	return column[y] / float(length[y])
+
+
+def nlevenshtein_within(seq1, seq2, threshold):
+	"""Check whether the normalized Levenshtein distance between `seq1` and
+	`seq2` is lower or equal to `threshold`. This is the same as:
+	
+		nlevenshtein(seq1, seq2, method=1) <= threshold
+	
+	but much faster when the sequences are not similar, because the normalized
+	threshold is first turned into a maximum number of edits (`threshold` times
+	the length of the longest sequence), which allows to reject the sequences on
+	their length difference alone, and else to compute only a diagonal band of
+	the edit matrix (Ukkonen's algorithm), stopping as soon as all the values in
+	the band exceed the maximum number of edits.
+	
+		>>> nlevenshtein_within("abcd", "abce", 0.25)  # dist = 0.25
+		True
+		>>> nlevenshtein_within("abcd", "abef", 0.25)  # dist = 0.5
+		False
+	"""
+	if seq1 == seq2:
+		return 0.0 <= threshold
+	len1, len2 = len(seq1), len(seq2)
+	if len1 == 0 or len2 == 0:
+		return 1.0 <= threshold
+	if len1 < len2:
+		len1, len2 = len2, len1
+		seq1, seq2 = seq2, seq1
+	
+	# Maximum number of edits, using the same float division as nlevenshtein
+	# to avoid any rounding discrepancy
+	max_dist = min(len1, max(0, int(threshold * len1) + 1))
+	while max_dist >= 0 and max_dist / float(len1) > threshold:
+		max_dist -= 1
+	if max_dist < 0 or len1 - len2 > max_dist:
+		return False
+	if max_dist >= len1:
+		return True
+	
+	# Banded edit matrix: only the cells at most max_dist away from the diagonal
+	# can hold a value <= max_dist, the others are capped at max_dist + 1
+	cap = max_dist + 1
+	column = [y if y <= max_dist else cap for y in range(len2 + 1)]
+	for x in range(1, len1 + 1):
+		low, high = max(1, x - max_dist), min(len2, x + max_dist)
+		new = [cap] * (len2 + 1)
+		new[0] = x if x <= max_dist else cap
+		best = new[0]
+		for y in range(low, high + 1):
+			value = min(column[y] + 1, new[y - 1] + 1, column[y - 1] + (seq1[x - 1] != seq2[y - 1]))
+			if value > cap:
+				value = cap
+			new[y] = value
+			if value < best:
+				best = value
+		if best > max_dist:
+			return False
+		column = new
+	return column[len2] <= max_dist
@@ -3,3 +3,4 @@ from ._lcsubstrings import *
 from ._levenshtein import *
 from ._simpledists import *
 from ._iterators import *
+from ._bitparallel import *
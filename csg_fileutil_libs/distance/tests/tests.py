@@ -149,6 +149,38 @@ def nlevenshtein(func, t, **kwargs):
 	assert func(t("abc"), t("adb"), 2) == 0.5
 
 
+def nlevenshtein_within(func, t, **kwargs):
+
+	# empty strings
+	assert func(t(""), t(""), 0.0)
+	assert func(t(""), t("foo"), 1.0) and func(t("foo"), t(""), 1.0)
+	assert not func(t(""), t("foo"), 0.9) and not func(t("foo"), t(""), 0.9)
+
+	# same results as nlevenshtein
+	seqs = [t("aa"), t("ab"), t("a"), t("abc"), t("adb"), t("abcd"), t("dcba"), t("ba" * 10), t("ab" * 10)]
+	for threshold in (0.0, 0.1, 0.25, 0.3333333333333333, 0.5, 0.6666666666666666, 1.0):
+		for seq1 in seqs:
+			for seq2 in seqs:
+				assert func(seq1, seq2, threshold) == (pydistance.nlevenshtein(seq1, seq2, 1) <= threshold)
+
+
+def nlevenshtein_many(func, t, **kwargs):
+
+	# empty strings
+	assert list(func(t(""), [t(""), t("foo")])) == [0.0, 1.0]
+	assert list(func(t("foo"), [t("")])) == [1.0]
+	assert list(func(t("foo"), [])) == []
+
+	# same results as nlevenshtein
+	cands = [t("aa"), t("ab"), t("a"), t("abc"), t("adb"), t("ba" * 40), t("ab" * 40)]
+	for query in (t("ab"), t("abc"), t("ab" * 35)):
+		assert list(func(query, cands)) == [pydistance.nlevenshtein(query, c, 1) for c in cands]
+
+	# dist limit
+	assert list(func(t("ab"), [t("ab"), t("aa"), t("abcd"), t("cd")], max_dist=0.5)) == [0.0, 0.5, 0.5, -1.0]
+	assert list(func(t("a"), [t("b")], max_dist=0.0)) == [-1.0]
+
+
 def lcsubstrings(func, t, **kwargs):
 
 	# types; only for c
@@ -217,11 +249,11 @@ def ifast_comp(func, t, **kwargs):
 
 write = lambda s: sys.stderr.write(s + '\n')
 
-tests = ["hamming", "fast_comp", "levenshtein", "lcsubstrings", "nlevenshtein", "ilevenshtein", "ifast_comp"]
+tests = ["hamming", "fast_comp", "levenshtein", "lcsubstrings", "nlevenshtein", "ilevenshtein", "ifast_comp", "nlevenshtein_within", "nlevenshtein_many"]
 
 
 def run_test(name):
-	if cdistance:
+	if cdistance and hasattr(cdistance, name):
 		cfunc = getattr(cdistance, name)
 		run_lang_test(name, cfunc, "C")
 		write("")
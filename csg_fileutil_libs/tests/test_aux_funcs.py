@@ -0,0 +1,785 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from csg_fileutil_libs import aux_funcs
+
+
+class PairsCacheTest(unittest.TestCase):
+    NAMES1 = ['jean dupont', 'marie curie', 'paul martin', 'alice smith', 'bob marley']
+    NAMES2 = ['jean dupond', 'marie curi', 'pierre durand', 'alice smyth', 'paul martine']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'pairs.sqlite')
+        self.params = aux_funcs.PairsCache.params(dist=0.2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compute(self, i, name2):
+        return (float(i), 0.5)
+
+    def test_reuse(self):
+        cache = aux_funcs.PairsCache(self.path)
+        items = list(enumerate(['a', 'b']))
+        self.assertEqual(cache.distances('x', items, self.compute, self.params), [(0.0, 0.5), (1.0, 0.5)])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        # The new pairs are reused before and after being written to disk
+        self.assertEqual(cache.distances('x', items, lambda i, name2: (9.0, 9.0), self.params), [(0.0, 0.5), (1.0, 0.5)])
+        cache.close()
+        cache = aux_funcs.PairsCache(self.path)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.distances('x', items, lambda i, name2: (9.0, 9.0), self.params), [(0.0, 0.5), (1.0, 0.5)])
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        # Other parameters are other pairs
+        cache.distances('x', items, self.compute, aux_funcs.PairsCache.params(dist=0.3))
+        self.assertEqual(cache.misses, 2)
+        cache.close()
+
+    def test_eviction_keeps_used_pairs(self):
+        cache = aux_funcs.PairsCache(self.path, maxsize=2)
+        cache.distances('x', list(enumerate(['a', 'b'])), self.compute, self.params)
+        cache.flush()
+        # Only the pair (x, a) is used again, (x, b) is the least recently used pair
+        cache.distances('x', [(0, 'a')], self.compute, self.params)
+        cache.flush()
+        cache.distances('y', [(0, 'c')], self.compute, self.params)
+        cache.flush()
+        stored = set(cache.conn.execute('SELECT name1, name2 FROM pairs'))
+        self.assertEqual(stored, set([('x', 'a'), ('y', 'c')]))
+        cache.close()
+
+    def test_no_write_lock_between_flushes(self):
+        cache1 = aux_funcs.PairsCache(self.path, timeout=0.1)
+        cache2 = aux_funcs.PairsCache(self.path, timeout=0.1)
+        cache1.distances('x', [(0, 'a')], self.compute, self.params)
+        # cache1 has pending pairs, but cache2 can still write
+        cache2.distances('y', [(0, 'b')], self.compute, self.params)
+        cache2.flush()
+        cache1.flush()
+        self.assertEqual(len(cache1), 2)
+        cache1.close()
+        cache2.close()
+
+    def merge(self, **kwargs):
+        df1 = pd.DataFrame({'Name': self.NAMES1, 'a': range(len(self.NAMES1))})
+        df2 = pd.DataFrame({'Name': self.NAMES2, 'b': range(len(self.NAMES2))})
+        return aux_funcs.merge_two_df(df1, df2, col='Name', dist_threshold=0.2, **kwargs)
+
+    def test_merge_n_jobs(self):
+        expected = self.merge()
+        # First run fills the cache, second run only hits it
+        for run in range(2):
+            cache = aux_funcs.PairsCache(self.path)
+            cache.hits = 5
+            cascade_stats = {'exact': 100}
+            res = self.merge(n_jobs=2, pairs_cache=cache, cascade_stats=cascade_stats)
+            self.assertTrue(res.equals(expected))
+            if run == 0:
+                self.assertEqual(cache.hits, 5)
+                self.assertTrue(cache.misses > 0)
+                misses = cache.misses
+            else:
+                # The statistics inherited by the workers are not counted again
+                self.assertEqual((cache.hits, cache.misses), (5 + misses, 0))
+            self.assertTrue(sum(cascade_stats.values()) - 100 <= len(self.NAMES1) * len(self.NAMES2))
+            self.assertEqual(len(cache), misses)
+            cache.close()
+
+
+class LoadDbTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.csv')
+        self.df = pd.DataFrame({'name': ['b', 'a', None, 'None'],
+                                'values': [['x', 'y'], None, 'z', 3],
+                                'num': [1, None, 3, 4],
+                                'date': pd.to_datetime(['2020-01-02', None, '2020-01-03', '2020-01-04']),
+                               })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assert_warm_equals_cold(self, path, **kwargs):
+        cold = aux_funcs.load_db(path, cache=False, **kwargs)
+        self.assertTrue(os.path.exists(path + '.cache'))
+        # The warm load must not parse the csv
+        load_df_from_csv = aux_funcs.load_df_from_csv
+        def fail(*args, **kwargs):
+            raise AssertionError('the csv was parsed')
+        aux_funcs.load_df_from_csv = fail
+        try:
+            warm = aux_funcs.load_db(path, **kwargs)
+        finally:
+            aux_funcs.load_df_from_csv = load_df_from_csv
+        pd.testing.assert_frame_equal(warm, cold)
+
+    def test_save_db(self):
+        path = aux_funcs.save_db(self.df, self.path, csv_order_by='name')
+        self.assertEqual(path, self.path)
+        self.assert_warm_equals_cold(path)
+
+    def test_save_db_blankna(self):
+        path = aux_funcs.save_db(self.df, self.path, blankna=True)
+        self.assert_warm_equals_cold(path)
+
+    def test_load_db(self):
+        aux_funcs.save_df_as_csv(self.df, self.path)
+        aux_funcs.load_db(self.path)
+        self.assert_warm_equals_cold(self.path)
+
+    def test_load_db_params(self):
+        aux_funcs.save_db(self.df, self.path)
+        # A sidecar built with other arguments is not reused
+        self.assertEqual(list(aux_funcs.load_db(self.path, usecols=['name']).columns), ['name'])
+        self.assertEqual(len(aux_funcs.load_db(self.path).columns), 4)
+
+
+class MultivalueTest(unittest.TestCase):
+    VALUES = [['a', 'b'], [u'\xe9t\xe9', None, 1, 2.5], ['with "quotes"', 'with, comma', '[brackets]'], [],
+              u'[REDACTED]', u'@mv["not", "a", "list"]', u'\\@mv[escaped]', u'@mvx', u'plain', None, 3]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        for x in self.VALUES:
+            self.assertEqual(aux_funcs.parse_multivalue(aux_funcs.serialize_multivalue(x)), x)
+        self.assertEqual(aux_funcs.parse_multivalue(aux_funcs.serialize_multivalue(('a', 'b'))), ['a', 'b'])
+
+    def test_plain_strings_untouched(self):
+        for x in ['[REDACTED]', "['a', 'b']", '@mv', '@mv[not json', 'C:\\data']:
+            self.assertEqual(aux_funcs.parse_multivalue(x), x)
+
+    def test_literal_eval(self):
+        serialized = aux_funcs.serialize_multivalue(['a', None])
+        self.assertEqual(aux_funcs.df_literal_eval(serialized), ['a', None])
+        self.assertEqual(aux_funcs.multivalue_eval(serialized), ['a', None])
+        # Legacy format
+        self.assertEqual(aux_funcs.multivalue_eval("['a', 'b']"), ['a', 'b'])
+
+    def test_csv_roundtrip(self):
+        df = pd.DataFrame({'values': self.VALUES[:-1], 'other': range(len(self.VALUES) - 1)})
+        aux_funcs.save_df_as_csv(df, self.path, fields_order=False, multivalue=True)
+        res = aux_funcs.load_df_from_csv(self.path)
+        self.assertEqual(list(res['values'].iloc[:-1]), self.VALUES[:-2])
+        self.assertTrue(pd.isnull(res['values'].iloc[-1]))
+
+    def test_legacy_default(self):
+        df = pd.DataFrame({'values': [['a', 'b'], u'[REDACTED]']})
+        aux_funcs.save_df_as_csv(df, self.path)
+        res = aux_funcs.load_df_from_csv(self.path)
+        # The lists are written as pandas writes them (the legacy format), and nothing is parsed back
+        legacy_path = os.path.join(self.tmpdir, 'legacy.csv')
+        df.to_csv(legacy_path, sep=';', index=False, encoding='utf-8-sig')
+        self.assertEqual(list(res['values']), list(pd.read_csv(legacy_path, sep=';')['values']))
+        self.assertEqual(res['values'].iloc[1], '[REDACTED]')
+
+    def test_duplicated_columns(self):
+        df = pd.DataFrame([[['a'], 1, ['b', 'c']], ['x', 2, 'y']], columns=['v', 'n', 'v'])
+        serialized = aux_funcs.df_serialize_multivalue(df)
+        self.assertEqual(list(serialized.iloc[:, 0]), ['@mv["a"]', 'x'])
+        self.assertEqual(list(serialized.iloc[:, 2]), ['@mv["b", "c"]', 'y'])
+        parsed = aux_funcs.df_parse_multivalue(serialized)
+        self.assertEqual(list(parsed.iloc[:, 0]), [['a'], 'x'])
+        self.assertEqual(list(parsed.iloc[:, 2]), [['b', 'c'], 'y'])
+
+
+class CleanupNamesTest(unittest.TestCase):
+    @unittest.skipIf(sys.version_info[0] >= 3, 'byte string names are only supported in Python 2')
+    def test_mixed_encodings(self):
+        latin1 = [x.encode('latin-1') for x in [u'Fran\xe7ois H\xe9bert', u'H\xe9l\xe8ne Dupr\xe9', u'J\xe9r\xf4me Lef\xe8vre', u'C\xe9cile Lema\xeetre']] * 5
+        utf8 = [u'Jos\xe9 \xc9mile'.encode('utf-8'), u'\xc5ngstr\xf6m Zo\xeb'.encode('utf-8')]
+        res = aux_funcs.cleanup_names(latin1 + utf8 + ['Plain  Name', None])
+        self.assertEqual(list(res[:4]), ['francois hebert', 'helene dupre', 'jerome lefevre', 'cecile lemaitre'])
+        # UTF-8 names are never decoded with the single-byte encoding of the rest of the column
+        self.assertEqual(list(res[-4:]), ['jose emile', 'angstrom zoe', 'plain name', None])
+
+    def test_unicode(self):
+        names = [u'Jos\xe9  \xc9mile', u'jean-pierre, Dupont', u'jean-pierre, Dupont', None]
+        res = aux_funcs.cleanup_names(names)
+        self.assertEqual(list(res[:3]), [aux_funcs.cleanup_name(x) for x in names[:3]])
+        self.assertTrue(pd.isnull(res[3]))
+
+
+class AppendCsvDatabasesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db1 = os.path.join(self.tmpdir, 'db1.csv')
+        self.db2 = os.path.join(self.tmpdir, 'db2.csv')
+        with open(self.db1, 'w') as f:
+            f.write('name;b;a\njohn;1;x\n;;\npaul;2;\n')
+        with open(self.db2, 'w') as f:
+            f.write('c;name;a\n3.0;george;y\n;;\n;ringo;z\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, path):
+        return pd.read_csv(path, sep=';', dtype=object, na_filter=False)
+
+    def test_append(self):
+        output = os.path.join(self.tmpdir, 'out.csv')
+        for unicode_fix in [False, True]:
+            self.assertTrue(aux_funcs.append_csv_databases([self.db1, self.db2], output, unicode_fix=unicode_fix, chunksize=1))
+            res = self.load(output)
+            # Union of the columns in their order of appearance
+            self.assertEqual(list(res.columns), ['name', 'b', 'a', 'c'])
+            # Empty rows are dropped and cells are kept as written
+            self.assertEqual(res.values.tolist(), [['john', '1', 'x', ''], ['paul', '2', '', ''], ['george', '', 'y', '3.0'], ['ringo', '', 'z', '']])
+
+    def test_read_header(self):
+        # Only the header, with the column names decoded
+        header = next(aux_funcs._csv_read_chunks(self.db1, nrows=0))
+        self.assertEqual(len(header), 0)
+        self.assertEqual(list(header.columns), [u'name', u'b', u'a'])
+        self.assertTrue(all(isinstance(c, unicode) for c in header.columns))
+
+    def test_append_inplace(self):
+        aux_funcs.append_csv_databases([self.db1, self.db2], self.db1, unicode_fix=False)
+        res = self.load(self.db1)
+        self.assertEqual(list(res['name']), ['john', 'paul', 'george', 'ringo'])
+        # No temporary file is left
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['db1.csv', 'db2.csv'])
+
+
+class DisambiguateNamesTest(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'name': ['jean dupont', 'marie curie', 'jean dupond', 'jean dupont', 'marie curi', 'paul martin', None]})
+
+    def test_disambiguate(self):
+        for blocking in [True, False]:
+            res = aux_funcs.disambiguate_names(self.df, blocking=blocking)
+            self.assertEqual(list(res['name'][:6]), ['jean dupont', 'marie curie', 'jean dupont', 'jean dupont', 'marie curie', 'paul martin'])
+            self.assertTrue(pd.isnull(res['name'].iloc[6]))
+            # Only the rows with the kept spelling get the other spellings
+            self.assertEqual(list(res['name_alt']), ['jean dupond', 'marie curi', '', 'jean dupond', '', '', ''])
+
+    def test_pairs_compared_once(self):
+        pairs = []
+        match_names_cascade = aux_funcs.match_names_cascade
+        def count(name1, name2, *args, **kwargs):
+            pairs.append(frozenset([name1, name2]))
+            return match_names_cascade(name1, name2, *args, **kwargs)
+        aux_funcs.match_names_cascade = count
+        try:
+            aux_funcs.disambiguate_names(self.df, blocking=False)
+        finally:
+            aux_funcs.match_names_cascade = match_names_cascade
+        # 5 unique names, each unordered pair once
+        self.assertEqual(len(pairs), 10)
+        self.assertEqual(len(set(pairs)), 10)
+
+
+class DfTranslateTest(unittest.TestCase):
+    def test_partial_inline_flags(self):
+        df = pd.DataFrame({'diag': ['BAZ', 'a BAR', 'baz', 'Qux', 'qux', 'FOO', 'foo', None]})
+        mapping = OrderedDict([('foo', 'F'), ('(?i)bar', 'B'), ('baz', 'Z'), ('(?i)^qux$', 'Q')])
+        res = aux_funcs.df_translate(df, 'diag', mapping, partial=True)
+        # The global flags of (?i)bar and (?i)^qux$ do not leak to the other patterns
+        self.assertEqual(list(res['diag'][:7]), ['BAZ', 'B', 'Z', 'Q', 'Q', 'FOO', 'F'])
+        self.assertTrue(pd.isnull(res['diag'].iloc[7]))
+
+    def test_matcher_many_patterns(self):
+        patterns = ['p%i' % i for i in range(100)] + ['(?i)UPPER', '(a)\\1']
+        find_all = aux_funcs._multi_pattern_matcher(patterns)
+        self.assertEqual(find_all('p1 p42 p99 upper aa'), [1, 4, 9, 42, 99, 100, 101])
+
+
+class EncodingsSidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.csv')
+        with open(self.path, 'w') as f:
+            f.write('name;diag\njohn;mcs\npaul;coma\n')
+        self.df = aux_funcs.load_df_from_csv(self.path, dtype=object)
+        aux_funcs._encodings_cache.clear()
+
+    def tearDown(self):
+        aux_funcs._encodings_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def detections(self):
+        """Run df_to_unicode_fast() on the csv with an empty memory cache, and return the number of columns which encoding was detected"""
+        aux_funcs._encodings_cache.clear()
+        calls = []
+        detect_encoding = aux_funcs.detect_encoding
+        def count(*args, **kwargs):
+            calls.append(1)
+            return detect_encoding(*args, **kwargs)
+        aux_funcs.detect_encoding = count
+        try:
+            aux_funcs.df_to_unicode_fast(self.df, source=self.path)
+        finally:
+            aux_funcs.detect_encoding = detect_encoding
+        return len(calls)
+
+    def test_persisted(self):
+        self.assertEqual(self.detections(), 2)
+        self.assertTrue(os.path.exists(self.path + '.encodings'))
+        # Reused from the sidecar by a new session
+        self.assertEqual(self.detections(), 0)
+        # Detected again once the file is modified
+        with open(self.path, 'a') as f:
+            f.write('george;emcs\n')
+        self.assertEqual(self.detections(), 2)
+
+    def test_not_persisted(self):
+        aux_funcs.df_to_unicode_fast(self.df, source=self.path, persist=False)
+        self.assertFalse(os.path.exists(self.path + '.encodings'))
+
+
+class DfToUnicodeTest(unittest.TestCase):
+    def setUp(self):
+        # Latin-1 strings (the failsafe encoding of df_to_unicode())
+        self.df = pd.DataFrame([['caf\xe9', 1, 'th\xe9'], ['x', 2, None]], columns=['v', 'n', 'v'])
+
+    @unittest.skipIf(sys.version_info[0] >= 3, 'byte strings are only decoded in Python 2')
+    def test_duplicated_columns(self):
+        res = aux_funcs.df_to_unicode(self.df)
+        self.assertEqual(list(res.columns), ['v', 'n', 'v'])
+        self.assertEqual(list(res.iloc[:, 0]), [u'caf\xe9', u'x'])
+        self.assertEqual(list(res.iloc[:, 1]), [1, 2])
+        self.assertEqual(list(res.iloc[:, 2]), [u'th\xe9', None])
+        self.assertTrue(all(isinstance(x, unicode) for x in res.iloc[:, 0]))
+        # And back
+        res = aux_funcs.df_encode(res)
+        self.assertEqual(list(res.iloc[:, 0]), ['caf\xc3\xa9', 'x'])
+        self.assertEqual(list(res.iloc[:, 2]), ['th\xc3\xa9', None])
+        self.assertFalse(any(isinstance(x, unicode) for x in res.iloc[:, 0]))
+
+
+class DfConcatValsTest(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'name': ['a', 'a', 'b', 'c', 'c', 'd', 'e', 'e'],
+                                'visit': ['x', 'x', 'y', 'z', 'z', 'w', 'v', 'v'],
+                                'date': pd.to_datetime(['2020-01-01', '2020-01-02', '2020-01-03', None, '2020-01-04', None, '2020-01-05', '2020-01-05']),
+                                'num': [1, 2, 3, 4, 4, 5, 6, 7],
+                                'score': [1.0, np.nan, 2.5, np.nan, np.nan, 3.0, 1.0, 1.0],
+                                'diag': ['mcs', 'mcs', None, 'coma', '', None, 'lis', 'emcs'],
+                               }, columns=['name', 'visit', 'date', 'num', 'score', 'diag'])
+
+    def test_same_as_agg(self):
+        for key in ['name', ['name', 'visit']]:
+            res = aux_funcs.df_concat_vals(self.df, key)
+            ref = self.df.groupby(key, sort=False).agg(aux_funcs.concat_vals)
+            # Dates are kept as Timestamp/NaT, with the same dtype
+            pd.testing.assert_series_equal(res['date'], ref['date'])
+            self.assertEqual(res['date'].dtype.kind, 'M')
+            for col in ['num', 'score', 'diag']:
+                self.assertEqual([repr(x) for x in res[col]], [repr(x) for x in ref[col]])
+
+    def test_concatenate_all_but(self):
+        res = aux_funcs.df_concatenate_all_but(self.df, 'name')
+        self.assertEqual(list(res['name']), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(res['date'].iloc[1], pd.Timestamp('2020-01-03'))
+        self.assertEqual(res['date'].iloc[4], pd.Timestamp('2020-01-05'))
+        self.assertEqual(res['num'].iloc[0], [1, 2])
+        self.assertEqual(res['diag'].iloc[4], ['lis', 'emcs'])
+
+
+class SaveDfAsCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'db.csv')
+        self.df = pd.DataFrame({'name': ['b', 'a', None, 'None', 'c'],
+                                'num': [1.0, 2.0, None, 3.0, 4.0],
+                                'count': [1, 2, 3, 4, 5],
+                                'date': pd.to_datetime(['2020-01-01', '2020-01-02', None, '2020-01-04', '2020-01-05']),
+                                'values': [['x'], None, 'nan', 'y', 'z'],
+                               }, columns=['name', 'num', 'count', 'date', 'values'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            return f.read()
+
+    def test_chunks(self):
+        for blankna in [False, True]:
+            aux_funcs.save_df_as_csv(self.df, self.path, blankna=blankna, csv_order_by='name')
+            whole = self.read(self.path)
+            for chunksize in [1, 2, 3]:
+                # Some chunks have no null value in a column which has some in other chunks
+                aux_funcs.save_df_as_csv(self.df, self.path, blankna=blankna, csv_order_by='name', chunksize=chunksize)
+                self.assertEqual(self.read(self.path), whole)
+
+    def test_blankna(self):
+        aux_funcs.save_df_as_csv(self.df, self.path, fields_order=False, blankna=True, chunksize=2)
+        res = pd.read_csv(self.path, sep=';', dtype=object, na_filter=False, encoding='utf-8-sig')
+        self.assertEqual(list(res.columns), ['name', 'num', 'count', 'date', 'values'])
+        self.assertEqual(list(res['name']), ['b', 'a', '', '', 'c'])
+        self.assertEqual(list(res['num']), ['1.0', '2.0', '', '3.0', '4.0'])
+        self.assertEqual(list(res['count']), ['1', '2', '3', '4', '5'])
+        self.assertEqual(res['date'][2], '')
+        self.assertEqual(list(res['values'])[1:], ['', '', 'y', 'z'])
+
+    def test_compress(self):
+        aux_funcs.save_df_as_csv(self.df, self.path, compress=True)
+        self.assertEqual(os.listdir(self.tmpdir), ['db.csv.gz'])
+        aux_funcs.save_df_as_csv(self.df, self.path)
+        self.assertEqual(self.read(self.path + '.gz'), self.read(self.path))
+
+    def test_fields_order(self):
+        aux_funcs.save_df_as_csv(self.df, self.path, fields_order=['num', 'missing'])
+        res = pd.read_csv(self.path, sep=';', encoding='utf-8-sig')
+        # The specified fields first, then the others alphabetically
+        self.assertEqual(list(res.columns), ['num', 'missing', 'count', 'date', 'name', 'values'])
+        self.assertEqual(len(res), 5)
+        # No temporary file is left
+        self.assertEqual(os.listdir(self.tmpdir), ['db.csv'])
+
+
+class SchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(OrderedDict([
+            ('unified.diagnosis_best', ['EMCS', 'VS/UWS', None, 'EMCS']),
+            ('unified.etiology', [['anoxia', 'trauma'], 'trauma', None, 'anoxia']),
+            ('crs_score', ['5', '', 'None', '12']),
+            ('crs_total', ['1', '2', '3', '4']),
+            ('crsr_best_score', [['1', '2'], '3', '', '4']),
+            ('unified.age', ['1.5', 'NA', '2', '']),
+            ('birthdate', ['2020-01-02', '', 'nat', '2020-01-04']),
+        ]))
+        self.nullable = hasattr(pd, 'Int64Dtype')
+
+    def test_apply_schema(self):
+        res = aux_funcs.df_apply_schema(self.df)
+        self.assertEqual(res['unified.diagnosis_best'].dtype.name, 'category')
+        # Null values, hidden as strings or not, become null values
+        self.assertEqual(res['crs_score'].dtype.name, 'Int64' if self.nullable else 'float64')
+        self.assertEqual(res['crs_score'].isnull().tolist(), [False, True, True, False])
+        self.assertEqual(res['crs_score'].dropna().astype('int64').tolist(), [5, 12])
+        self.assertEqual(res['crs_total'].dtype.name, 'Int64' if self.nullable else 'int64')
+        self.assertEqual(res['crs_total'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(res['unified.age'].dtype.name, 'float64')
+        self.assertEqual(res['unified.age'].isnull().tolist(), [False, True, False, True])
+        self.assertEqual(res['birthdate'].tolist()[::3], [pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-04')])
+        self.assertEqual(res['birthdate'].isnull().tolist(), [False, True, True, False])
+        # Columns with multi-valued cells are kept as-is
+        for col in ['unified.etiology', 'crsr_best_score']:
+            self.assertEqual(res[col].tolist(), self.df[col].tolist())
+
+    def test_fillnastr(self):
+        serie = pd.Series(['a', ['x', 'y'], None, 'None', '#VALUE!', u'nan', ''])
+        res = aux_funcs.df_fillnastr(serie, replacement='-')
+        self.assertEqual(res.tolist(), ['a', ['x', 'y'], '-', '-', '-', '-', ''])
+        # The original is not modified
+        self.assertEqual(serie[3], 'None')
+
+
+class BlockingTest(unittest.TestCase):
+    NAMES1 = ['Jean Dupont', 'Marie Curie', 'Helene Lefevre', 'Anne-Sophie Martin', 'Bob', 'Jo', 'Paul']
+    NAMES2 = ['jean dupond', 'Curie Marie', 'helene lefevre', 'Martin Anne Sophie', 'Bo', 'Jo', 'pierre durand', 'Paule']
+
+    def test_candidates(self):
+        names = [aux_funcs.cleanup_name(x) for x in self.NAMES2]
+        index = aux_funcs.build_names_blocking_index(names)
+        for mode in [0, 1]:
+            self.assertEqual([names[i] for i in aux_funcs.blocking_candidates(index, 'jean dupont', mode=mode)], ['jean dupond'])
+            # Words in another order
+            self.assertEqual([names[i] for i in aux_funcs.blocking_candidates(index, 'marie curie', mode=mode)], ['curie marie'])
+            self.assertEqual(aux_funcs.blocking_candidates(index, 'zzz', mode=mode), set())
+
+    def test_merge_same_as_exhaustive(self):
+        df1 = pd.DataFrame({'Name': self.NAMES1, 'a': range(len(self.NAMES1))})
+        df2 = pd.DataFrame({'Name': self.NAMES2, 'b': range(len(self.NAMES2))})
+        for mode in [0, 1]:
+            for dist_threshold, dist_words_threshold in [(0.2, 0.4), (0.3, 0.5)]:
+                kwargs = dict(col='Name', dist_threshold=dist_threshold, dist_words_threshold=dist_words_threshold, mode=mode)
+                expected = aux_funcs.merge_two_df(df1, df2, **kwargs)
+                res = aux_funcs.merge_two_df(df1, df2, blocking=True, **kwargs)
+                pd.testing.assert_frame_equal(res, expected)
+                matches = dict(expected.dropna().values.tolist())
+                self.assertEqual(matches['Jean Dupont'], 'jean dupond')
+                self.assertEqual(matches['Paul'], 'Paule')
+                self.assertEqual('Marie Curie' in matches, mode == 0)
+
+
+class NamesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.maxsize = aux_funcs.names_cache_stats()['maxsize']
+        aux_funcs.names_cache_clear()
+
+    def tearDown(self):
+        aux_funcs.names_cache_clear(maxsize=self.maxsize)
+
+    def test_lru(self):
+        cache = aux_funcs.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is the least recently used entry
+        cache.set('c', 3)
+        self.assertEqual(sorted(cache._data.keys()), ['a', 'c'])
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    def test_normalize_name(self):
+        for name in ['Jean DUPONT', 'DUPONT^JEAN', u'H\xe9l\xe8ne  Lef\xe8vre', 'M\xc3\xa9lanie']:
+            expected = aux_funcs.cleanup_name(aux_funcs.replace_buggy_accents(name))
+            self.assertEqual(aux_funcs.normalize_name(name), expected)
+            # Second call from the cache
+            self.assertEqual(aux_funcs.normalize_name(name), expected)
+        self.assertEqual(aux_funcs.normalize_name('Jean-Luc', fix_accents=False, clean_nonletters=False), aux_funcs.cleanup_name('Jean-Luc', clean_nonletters=False))
+        stats = aux_funcs.names_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (4, 5, 5))
+
+    def test_normalize_names(self):
+        serie = pd.Series(['Jean DUPONT', None, 'jean dupont', 'Jean DUPONT', 'DUPONT^JEAN'], index=[4, 3, 2, 1, 0], dtype='object')
+        res = aux_funcs.normalize_names(serie)
+        self.assertEqual(list(res.index), [4, 3, 2, 1, 0])
+        self.assertEqual(res.tolist(), ['jean dupont', None, 'jean dupont', 'jean dupont', 'dupont jean'])
+        # Each distinct name is normalized only once
+        self.assertEqual(aux_funcs.names_cache_stats()['misses'], 3)
+
+
+class NameIndexTest(unittest.TestCase):
+    NAMES = ['Jean Dupont', 'JEAN  DUPONT', 'jean dupond', 'DUPONT^JEAN', 'Marie Curie', 'Marie Curi', 'Helene Lefevre', 'Paul', 'Paule', 'Pol', 'Jo', '', 'Anne-Sophie Martin']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = aux_funcs.NameIndex(self.NAMES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def brute_force(self, name, max_dist):
+        name = aux_funcs.normalize_name(name)
+        res = []
+        for n in self.NAMES:
+            if not n:
+                continue
+            cname = aux_funcs.normalize_name(n)
+            nd = aux_funcs.distance.levenshtein(name, cname) / float(max(len(name), len(cname)))
+            if nd <= max_dist:
+                res.append((nd, n))
+        return sorted(res)
+
+    def test_query(self):
+        self.assertEqual(len(self.index), 11)
+        self.assertTrue('JEAN DUPONT' in self.index)
+        # Duplicated names after normalization are all returned
+        self.assertEqual(self.index.query('jean dupont', 0.0), [(0.0, 'Jean Dupont'), (0.0, 'JEAN  DUPONT')])
+        for name in ['Jean Dupont', 'Paul', 'marie curie', 'Martin', 'zzz']:
+            for max_dist in [0.0, 0.2, 0.5, 1.0]:
+                self.assertEqual(sorted(self.index.query(name, max_dist)), self.brute_force(name, max_dist))
+
+    def test_save_load(self):
+        path = os.path.join(self.tmpdir, 'names.idx')
+        self.assertTrue(self.index.save(path))
+        index = aux_funcs.NameIndex.load(path)
+        self.assertEqual(index.names_clean, self.index.names_clean)
+        self.assertEqual(index.query('Paul', 0.4), self.index.query('Paul', 0.4))
+
+    def test_merge(self):
+        df1 = pd.DataFrame({'Name': ['Jean Dupont', 'Marie Curie', 'Pierre Durand', 'Anne Sophie Martin'], 'a': range(4)})
+        df2 = pd.DataFrame({'Name': ['jean dupond', 'Marie Curi', 'Pierre Durant', 'Martin Anne-Sophie'], 'b': range(4)})
+        expected = aux_funcs.merge_two_df(df1, df2, col='Name')
+        # 'Pierre Durant' is not in the index, it is still compared
+        index = aux_funcs.NameIndex(['jean dupond', 'Marie Curi', 'Martin Anne-Sophie', 'Paul'])
+        res = aux_funcs.merge_two_df(df1, df2, col='Name', blocking=index)
+        pd.testing.assert_frame_equal(res, expected)
+        self.assertEqual(dict(res.dropna().values.tolist())['Pierre Durand'], 'Pierre Durant')
+
+
+class WordsJaccardMatcherTest(unittest.TestCase):
+    NAMES = ['jean dupont', 'dupont jean', 'jean-luc dupond', 'jea dupont jean', 'al martin', 'allan martine', 'martin al', 'j dupont', 'marie curie, jean', 'x']
+
+    def test_same_as_distance_jaccard_words(self):
+        for partial in [False, True]:
+            for norm in [False, True, None]:
+                for dist in [0, 0.2, 0.4]:
+                    for minlength in [0, 3]:
+                        kwargs = dict(partial=partial, norm=norm, dist=dist, minlength=minlength)
+                        matcher = aux_funcs.WordsJaccardMatcher(self.NAMES, **kwargs)
+                        for name1 in self.NAMES + ['jean', 'dupont jean jean', 'allan', '']:
+                            for i, name2 in enumerate(self.NAMES):
+                                self.assertEqual(matcher.distance(name1, i), aux_funcs.distance_jaccard_words_split(name1, name2, **kwargs), (name1, name2, kwargs))
+
+
+class NamesDistanceMatrixTest(unittest.TestCase):
+    LIST1 = ['Jean Dupont', 'Marie Curie', 'jean dupont', 'Paul', 'Zoe']
+    LIST2 = ['jean dupond', 'Dupont Jean', 'Curie Marie', 'Paule', 'Pol', 'Pierre Durand']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def brute_force(self):
+        """Scored matches (i, j, dist_letters, dist_words) of an exhaustive comparison with the default thresholds"""
+        names1 = [aux_funcs.normalize_name(x) for x in self.LIST1]
+        names2 = [aux_funcs.normalize_name(x) for x in self.LIST2]
+        res = []
+        for i, n1 in enumerate(names1):
+            for j, n2 in enumerate(names2):
+                dchars = aux_funcs.distance.nlevenshtein(n1, n2, method=1)
+                dwords = aux_funcs.distance_jaccard_words_split(n1, n2, partial=False, norm=True, dist=0.2)
+                if dchars <= 0.2 or dwords <= 0.2:
+                    res.append((i, j, dchars, dwords))
+        return res
+
+    def test_dict(self):
+        res = aux_funcs.compute_names_distance_matrix(self.LIST1, self.LIST2)
+        expected = {}
+        for i, j, _, _ in self.brute_force():
+            expected.setdefault(aux_funcs.normalize_name(self.LIST1[i]), set()).add(aux_funcs.normalize_name(self.LIST2[j]))
+        self.assertEqual(sorted(res.keys()), ['jean dupont', 'marie curie', 'paul', 'zoe'])
+        self.assertEqual(res['zoe'], None)
+        self.assertEqual(dict((k, set(v)) for k, v in res.items() if v), expected)
+        # Same result with a prebuilt NameIndex
+        self.assertEqual(aux_funcs.compute_names_distance_matrix(self.LIST1, aux_funcs.NameIndex(self.LIST2)), res)
+
+    def test_coo(self):
+        rows, cols, dists_letters, dists_words = aux_funcs.compute_names_distance_matrix(self.LIST1, self.LIST2, output='coo')
+        self.assertEqual(rows.dtype, np.int64)
+        self.assertEqual(sorted(zip(rows.tolist(), cols.tolist(), dists_letters.tolist(), dists_words.tolist())), self.brute_force())
+        # Same result with the distances from the pairs cache
+        path = os.path.join(self.tmpdir, 'pairs.sqlite')
+        for run in range(2):
+            res = aux_funcs.compute_names_distance_matrix(self.LIST1, self.LIST2, output='coo', pairs_cache=path)
+            self.assertEqual(sorted(zip(*[x.tolist() for x in res])), self.brute_force())
+
+    def test_top_k(self):
+        rows, cols, dists_letters, _ = aux_funcs.compute_names_distance_matrix(self.LIST1, self.LIST2, output='coo', top_k=1)
+        self.assertEqual(rows.tolist(), [0, 1, 2, 3])
+        # The closest name of each
+        self.assertEqual([self.LIST2[j] for j in cols], ['jean dupond', 'Curie Marie', 'jean dupond', 'Paule'])
+        res = aux_funcs.compute_names_distance_matrix(self.LIST1, self.LIST2, top_k=1)
+        self.assertEqual(res['jean dupont'], ['jean dupond'])
+
+
+class DateCleanTest(unittest.TestCase):
+    VALUES = ['2020-01-02', '02/01/2020', '20200102', '2020-01-02', '02/01/2020', None, np.nan, '', 'unknown', '2/1/2020', '31/02/2020', '2020-01-02 10:30', 'le 3 mars 2019 ?']
+
+    def test_same_as_date_clean(self):
+        stats = {}
+        res = aux_funcs.date_clean_serie(self.VALUES, route_stats=stats)
+        pd.testing.assert_series_equal(res, pd.Series(self.VALUES).apply(aux_funcs.date_clean))
+        # Each distinct value is parsed only once, by the first route that can
+        self.assertEqual(stats, {'iso': 1, 'dmy': 1, 'ymd': 1, 'dateutil': 3, 'failed': 1, 'empty': 2})
+
+    def test_df_date_clean(self):
+        df = pd.DataFrame({'date': self.VALUES[:6], 'other': range(6)})
+        stats = {}
+        res = aux_funcs.df_date_clean(df, 'date', route_stats=stats)
+        self.assertEqual(res['date'].dtype.name, 'datetime64[ns]')
+        self.assertEqual(res['date'].tolist()[:5], [pd.Timestamp('2020-01-02')] * 5)
+        self.assertTrue(pd.isnull(res['date'][5]))
+        self.assertEqual(sum(stats.values()), 3)
+        # The original is not modified
+        self.assertEqual(df['date'][0], '2020-01-02')
+
+
+class DiagnosisScaleTest(unittest.TestCase):
+    def setUp(self):
+        self.scale = aux_funcs.DiagnosisScale()
+        self.values = ['EMCS', ' mcs+ ', None, ['VS/UWS', 'MCS-'], aux_funcs.serialize_multivalue(['coma', 'lis']), []]
+
+    def test_encode(self):
+        self.assertEqual(len(self.scale), len(aux_funcs.DIAG_ORDER))
+        self.assertEqual(self.scale.encode(['coma', 'LIS', None, 'coma']).tolist(), [0, 6, -1, 0])
+        self.assertEqual(self.scale.encode(self.values, reduce='max').tolist(), [5, 4, -1, 3, 6, -1])
+        self.assertEqual(self.scale.encode(self.values, reduce='min').tolist(), [5, 4, -1, 1, 0, -1])
+        # Multi-valued cells are exploded with the same index
+        res = self.scale.encode(self.values)
+        self.assertEqual(list(res.index), [0, 1, 2, 3, 3, 4, 4, 5])
+        self.assertEqual(res.tolist(), [5, 4, -1, 1, 3, 0, 6, -1])
+        self.assertRaises(ValueError, self.scale.encode, ['coma', 'unknown'])
+
+    def test_decode(self):
+        codes = self.scale.encode(self.values, reduce='max')
+        self.assertEqual(self.scale.decode(codes).tolist(), ['emcs', 'mcs+', None, 'mcs-', 'lis', None])
+        self.assertEqual(self.scale.decode([0, -1]).tolist(), ['coma', None])
+
+    def test_best_worst(self):
+        index = pd.MultiIndex.from_tuples([('a', 1), ('a', 1), ('a', 2), ('b', 1), ('c', 1)], names=['name', 'date'])
+        serie = pd.Series(['MCS', 'coma', 'EMCS', None, ['vs/uws', 'mcs+']], index=index)
+        best = self.scale.best(serie)
+        self.assertEqual(best.to_dict(), {'a': 'emcs', 'b': None, 'c': 'mcs+'})
+        self.assertEqual(self.scale.worst(serie).to_dict(), {'a': 'coma', 'b': None, 'c': 'vs/uws'})
+        self.assertEqual(self.scale.best(serie, level=[0, 1]).to_dict(), {('a', 1): 'mcs', ('a', 2): 'emcs', ('b', 1): None, ('c', 1): 'mcs+'})
+        self.assertEqual(self.scale.worst(serie, level=None).tolist(), ['mcs', 'coma', 'emcs', None, 'vs/uws'])
+        # Same as compute_best_diag() for single diagnoses
+        single = serie.iloc[:4]
+        expected = aux_funcs.compute_best_diag(single, diag_order=self.scale, persubject=None).groupby(level=0).max()
+        self.assertEqual(self.scale.best(single).tolist(), [None if pd.isnull(x) else x for x in expected])
+
+
+class SaveDictAsCsvStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'out.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        return pd.read_csv(self.path, sep=';', dtype=object, na_filter=False)
+
+    def records(self, n=10):
+        for i in range(n):
+            yield {'name': 'subj%i' % (i % 4), 'id': str(i), 'z': str(n - i)}
+
+    def test_external_sort(self):
+        records = [(i % 3, i) for i in range(20)]
+        for max_rows_in_memory in [None, 1, 3, 100]:
+            res = list(aux_funcs.external_sort(iter(records), lambda x: x[0], max_rows_in_memory=max_rows_in_memory))
+            # Stable sort
+            self.assertEqual(res, sorted(records, key=lambda x: x[0]))
+        self.assertEqual(list(aux_funcs.external_sort([], lambda x: x, max_rows_in_memory=1)), [])
+
+    def test_stream(self):
+        self.assertTrue(aux_funcs.save_dict_as_csv_stream(self.records(), self.path, fields_order=['name']))
+        res = self.load()
+        self.assertEqual(list(res.columns), ['name', 'id', 'z'])
+        self.assertEqual(res['id'].tolist(), [str(i) for i in range(10)])
+
+    def test_order_by(self):
+        for max_rows_in_memory in [2, None]:
+            aux_funcs.save_dict_as_csv_stream(self.records(), self.path, csv_order_by='name', max_rows_in_memory=max_rows_in_memory)
+            res = self.load()
+            self.assertEqual(res['name'].tolist(), sorted(res['name']))
+            # Ties are kept in their original order
+            self.assertEqual(res['id'].tolist(), ['0', '4', '8', '1', '5', '9', '2', '6', '3', '7'])
+
+    def test_header(self):
+        # Only the columns of the first records, unless declared
+        records = [{'a': '1'}, {'a': '2', 'b': '3'}]
+        self.assertRaises(ValueError, aux_funcs.save_dict_as_csv_stream, iter(records), self.path, infer_rows=1)
+        aux_funcs.save_dict_as_csv_stream(iter(records), self.path, fields_order=['b', 'a'], infer_rows=0)
+        self.assertEqual(self.load().values.tolist(), [['', '1'], ['3', '2']])
+        # A dict of records
+        aux_funcs.save_dict_as_csv({'x': {'a': '1'}}, self.path)
+        self.assertEqual(self.load().values.tolist(), [['1']])
+
+    def test_interrupted(self):
+        aux_funcs.save_dict_as_csv_stream(self.records(), self.path)
+        def failing():
+            yield {'name': 'subj'}
+            raise IOError('interrupted')
+        self.assertRaises(IOError, aux_funcs.save_dict_as_csv_stream, failing(), self.path)
+        # The previous csv is left untouched, and no temporary file is left
+        self.assertEqual(len(self.load()), 10)
+        self.assertEqual(os.listdir(self.tmpdir), ['out.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()